@@ -1,20 +1,34 @@
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
+import asyncio
+import contextlib
+import hashlib
 import io
+import json
 import os
 import re
+import shutil
+import tempfile
+import threading
 import time
 import uuid
+from collections import OrderedDict, deque
 from fastapi.middleware.cors import CORSMiddleware
 
+# Optional: orjson encodes the large HTML payloads several times faster than the json module.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 app = FastAPI()
 
-# Allow CORS for frontend
+# Allow CORS for frontend. The frontend sends no cookies, so without allow_credentials
+# Starlette answers every origin with its precomputed "*" headers.
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
-    allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
@@ -91,44 +105,161 @@ except ImportError:
 
 if not USE_MOCK:
     # --- Real Aspose Implementation ---
+    # Optional: with zstandard installed, undo snapshots are stored as deltas against a recent full one.
+    try:
+        import zstandard
+    except ImportError:
+        zstandard = None
+
+    _color_cache: dict[str, object] = {}
+    _max_color_cache = 256
+
+    def _parse_color(value: str):
+        # Range edits apply the same color to every run, so parse each hex string once.
+        try:
+            return _color_cache[value]
+        except KeyError:
+            pass
+        c = None
+        if value.startswith("#"):
+            try:
+                hex_color = value.lstrip('#')[:6]
+                if len(hex_color) != 6:
+                    raise ValueError(f"invalid hex color {value!r}")
+                v = int(hex_color, 16)
+                c = drawing.Color.from_argb((v >> 16) & 0xFF, (v >> 8) & 0xFF, v & 0xFF)
+            except Exception as e:
+                print(f"Error setting color: {e}")
+        if len(_color_cache) >= _max_color_cache:
+            _color_cache.clear()
+        _color_cache[value] = c
+        return c
+
+    def _clamp(value: int, hi: int) -> int:
+        # Caret offsets from the client are pinned to [0, len(run text)].
+        return 0 if value < 0 else hi if value > hi else value
+
+    _ALIGNMENTS = {
+        "left": aw.ParagraphAlignment.LEFT,
+        "center": aw.ParagraphAlignment.CENTER,
+        "right": aw.ParagraphAlignment.RIGHT,
+        "justify": aw.ParagraphAlignment.JUSTIFY,
+    }
+
+    # Paragraph patches cut the inner HTML out of a full export: find the opening tag, then the
+    # first closing tag after it. Two literal searches, no lazy [\s\S]*? scan over the document.
+    _BODY_OPEN_RE = re.compile(r"<body[^>]*>", re.IGNORECASE)
+    _BODY_CLOSE_RE = re.compile(r"</body>", re.IGNORECASE)
+
     class DocumentState:
         def __init__(self):
             self.doc_id = uuid.uuid4().hex
             self.version = 0
             self.doc = None
-            self.undo_stack: list[bytes] = []
-            self.redo_stack: list[bytes] = []
+            # History entries are ("doc", snapshot_key) DOCX snapshots, ("clone", aw.Document) in-memory
+            # snapshots, ("style", [(bookmark_name, font_state), ...]) commands holding only the
+            # prior font state of the runs a range-style edit touched, or ("text", [(bookmark_name,
+            # text), ...]) commands holding the prior text of runs edited in place. Only structural
+            # edits (splits, breaks, paragraph merges) need a snapshot.
+            # Snapshot bytes live once in _snapshots (keyed by content hash, refcounted), so
+            # identical snapshots on either stack share a single copy. Each slot is
+            # [payload, refcount, base_key]: with zstandard available, most payloads are deltas
+            # against a full "keyframe" snapshot (base_key), which each delta holds a reference on.
+            # A new keyframe starts every snapshot_keyframe_interval snapshots, so a restore
+            # applies at most one delta.
+            self._snapshots: dict[bytes, list] = {}
+            self.snapshot_keyframe_interval = 10
+            self._delta_base: bytes | None = None
+            self._delta_count = 0
+            self._delta_dict: tuple[bytes, object] | None = None
             self.max_history = 50
+            self.undo_stack: deque[tuple[str, object]] = deque(maxlen=self.max_history)
+            self.redo_stack: deque[tuple[str, object]] = deque(maxlen=self.max_history)
+            # "clone" keeps snapshots as deep-copied Documents (restore is a swap, no DOCX parse),
+            # "serialize" stores DOCX bytes, "auto" clones documents up to clone_snapshot_max_runs runs.
+            # Clones use far more memory, so only the newest max_clone_snapshots stay in that form.
+            self.snapshot_mode = "auto"
+            self.clone_snapshot_max_runs = 2000
+            self.max_clone_snapshots = 10
             self._last_edit_time = 0.0
             self._last_edit_kind: str | None = None
-            self._applied_ops: dict[str, dict] = {}
-            self._applied_ops_order: list[str] = []
+            # Seconds within which consecutive edits of one kind share an undo step (slider drags,
+            # typing and held-down deletes); kinds not listed never coalesce.
+            self.coalesce_windows = {"insert": 2.5, "style": 1.0, "delete": 0.5}
+            self._applied_ops: OrderedDict[str, bytes] = OrderedDict()
             self._max_applied_ops = 5000
+            # Full-page responses are far larger than patches, so the cache is also bounded by size.
+            self._applied_ops_bytes = 0
+            self._max_applied_bytes = 64 * 1024 * 1024
+            # Internal revision of self.doc, bumped on every mutation; unlike `version` it never
+            # resets, so rendered HTML can be cached per (revision, page).
+            self._revision = 0
+            self._html_cache: OrderedDict[tuple[int, int | None], str] = OrderedDict()
+            self._max_html_cache = 8
+            # Revision the current page layout was computed for (-1: none yet).
+            self._layout_revision = -1
+            # page_count as read for that layout; every render asks for it to clamp the page index.
+            self._page_count = 1
+            self._page_count_revision = -1
+            self._bm_index: dict[str, object] = {}
+            self._bm_seq = 0
+            # Document-order list of Runs (cast once) plus run -> position, rebuilt after structural edits
+            self._runs_snapshot: list | None = None
+            self._run_index: dict | None = None
+            self._html_options = aw.saving.HtmlSaveOptions()
+            self._html_options.export_images_as_base64 = True
+            self._html_options.css_style_sheet_type = aw.saving.CssStyleSheetType.INLINE
+            # Compact output: indentation only adds whitespace text nodes around each paragraph's
+            # runs, which the browser never shows but the caret can land in.
+            self._html_options.pretty_format = False
+            self._html_fixed_options = aw.saving.HtmlFixedSaveOptions()
+            try:
+                self._html_fixed_options.export_embedded_images = True
+            except Exception:
+                pass
+            # Readers (render, download) may run side by side under the route lock, but Aspose
+            # itself is not thread-safe, so layout, rendering and saving still go one at a time.
+            self._aspose_lock = threading.RLock()
+            self._html_buffer = io.BytesIO()
+            # DOCX bytes of self.doc as last restored from history; None once the doc is edited.
+            self._current_bytes: bytes | None = None
             self.load_default()
 
         def _reset_identity(self):
             self.doc_id = uuid.uuid4().hex
             self.version = 0
 
+        def _touch(self):
+            self._revision += 1
+            self._current_bytes = None
+
         def _op_cache_key(self, req_doc_id: str, req_base_version: int, client_op_id: str, page: int | None):
             p = 0 if page is None else int(page)
             return f"{req_doc_id}:{int(req_base_version)}:{client_op_id}:{p}"
 
         def get_cached_response(self, req_doc_id: str, req_base_version: int, client_op_id: str, page: int | None):
             key = self._op_cache_key(req_doc_id, req_base_version, client_op_id, page)
-            return self._applied_ops.get(key)
+            body = self._applied_ops.get(key)
+            if body is not None:
+                self._applied_ops.move_to_end(key)
+            return body
 
-        def cache_response(self, req_doc_id: str, req_base_version: int, client_op_id: str, page: int | None, payload: dict):
+        def cache_response(self, req_doc_id: str, req_base_version: int, client_op_id: str, page: int | None, payload: dict) -> bytes:
             key = self._op_cache_key(req_doc_id, req_base_version, client_op_id, page)
-            if key in self._applied_ops:
-                return
-            self._applied_ops[key] = payload
-            self._applied_ops_order.append(key)
-            overflow = len(self._applied_ops_order) - self._max_applied_ops
-            if overflow > 0:
-                for _ in range(overflow):
-                    oldest = self._applied_ops_order.pop(0)
-                    self._applied_ops.pop(oldest, None)
+            body = self._applied_ops.get(key)
+            if body is not None:
+                self._applied_ops.move_to_end(key)
+                return body
+            # Stored encoded, so a replayed request is answered without serializing again.
+            body = _json_bytes(payload)
+            self._applied_ops[key] = body
+            self._applied_ops_bytes += len(body)
+            while len(self._applied_ops) > 1 and (
+                len(self._applied_ops) > self._max_applied_ops or self._applied_ops_bytes > self._max_applied_bytes
+            ):
+                _, evicted = self._applied_ops.popitem(last=False)
+                self._applied_ops_bytes -= len(evicted)
+            return body
 
         def validate_version(self, req_doc_id: str, req_base_version: int):
             if req_doc_id != self.doc_id:
@@ -140,31 +271,233 @@ if not USE_MOCK:
         def bump_version(self):
             self.version += 1
 
-        def _serialize_doc(self) -> bytes:
+        def _serialize_doc(self, doc=None) -> bytes:
             out_stream = io.BytesIO()
-            self.doc.save(out_stream, aw.SaveFormat.DOCX)
+            (doc or self.doc).save(out_stream, aw.SaveFormat.DOCX)
             return out_stream.getvalue()
 
+        def _set_doc(self, doc):
+            self.doc = doc
+            self._reindex_bookmarks()
+            self._invalidate_runs()
+
         def _restore_doc(self, doc_bytes: bytes):
-            self.doc = aw.Document(io.BytesIO(doc_bytes))
+            self._set_doc(aw.Document(io.BytesIO(doc_bytes)))
+            self._current_bytes = doc_bytes
+
+        def _current_snapshot(self) -> bytes:
+            # Consecutive undo/redo steps reuse the snapshot they just restored instead of
+            # saving the unchanged document again.
+            if self._current_bytes is None:
+                self._current_bytes = self._serialize_doc()
+            return self._current_bytes
+
+        def _store_snapshot(self, data: bytes) -> bytes:
+            key = hashlib.blake2b(data, digest_size=16).digest()
+            slot = self._snapshots.get(key)
+            if slot is None:
+                self._snapshots[key] = self._encode_snapshot(key, data)
+            else:
+                slot[1] += 1
+            return key
+
+        def _zstd_dict(self, base: bytes):
+            if self._delta_dict is None or self._delta_dict[0] != base:
+                self._delta_dict = (base, zstandard.ZstdCompressionDict(self._snapshots[base][0], dict_type=zstandard.DICT_TYPE_RAWCONTENT))
+            return self._delta_dict[1]
+
+        def _encode_snapshot(self, key: bytes, data: bytes) -> list:
+            base = self._delta_base
+            if zstandard is not None and base in self._snapshots and self._delta_count < self.snapshot_keyframe_interval:
+                encoded = zstandard.ZstdCompressor(dict_data=self._zstd_dict(base)).compress(data)
+                # A poor delta means the document changed wholesale; start a new keyframe instead.
+                if len(encoded) * 2 <= len(data):
+                    self._snapshots[base][1] += 1
+                    self._delta_count += 1
+                    return [encoded, 1, base]
+            self._delta_base = key
+            self._delta_count = 0
+            return [data, 1, None]
+
+        def _snapshot_data(self, key: bytes) -> bytes:
+            payload, _, base = self._snapshots[key]
+            if base is None:
+                return payload
+            return zstandard.ZstdDecompressor(dict_data=self._zstd_dict(base)).decompress(payload)
+
+        def _release_snapshot(self, key: bytes):
+            slot = self._snapshots.get(key)
+            if slot is None:
+                return
+            slot[1] -= 1
+            if slot[1] <= 0:
+                del self._snapshots[key]
+                if slot[2] is not None:
+                    self._release_snapshot(slot[2])
+
+        def _release_entry(self, entry: tuple[str, object]):
+            kind, payload = entry
+            if kind == "doc":
+                self._release_snapshot(payload)
+
+        def _push_entry(self, stack: deque, entry: tuple[str, object]):
+            if len(stack) == stack.maxlen:
+                self._release_entry(stack[0])
+            stack.append(entry)
+            if entry[0] == "clone":
+                self._demote_clone_snapshots()
+
+        def _demote_clone_snapshots(self):
+            # Oldest first: the bottom of the undo stack, then the far end of the redo stack.
+            clones = [(stack, i) for stack in (self.undo_stack, self.redo_stack) for i, e in enumerate(stack) if e[0] == "clone"]
+            for stack, i in clones[:max(0, len(clones) - self.max_clone_snapshots)]:
+                stack[i] = ("doc", self._store_snapshot(self._serialize_doc(stack[i][1])))
+
+        def _use_clone_snapshots(self) -> bool:
+            if self.snapshot_mode == "clone":
+                return True
+            if self.snapshot_mode == "serialize":
+                return False
+            return self.doc.get_child_nodes(aw.NodeType.RUN, True).count <= self.clone_snapshot_max_runs
+
+        def _snapshot_entry(self) -> tuple[str, object]:
+            if self._use_clone_snapshots():
+                return ("clone", self.doc.clone())
+            return ("doc", self._store_snapshot(self._serialize_doc()))
+
+        def _current_entry(self) -> tuple[str, object]:
+            # Only used right before self.doc is replaced, so the live Document can be kept as-is
+            # (restoring a clone entry installs a copy of it).
+            if self._use_clone_snapshots():
+                return ("clone", self.doc)
+            return ("doc", self._store_snapshot(self._current_snapshot()))
+
+        def _clear_stack(self, stack: deque):
+            for entry in stack:
+                self._release_entry(entry)
+            stack.clear()
+
+        def _clear_redo(self):
+            self._clear_stack(self.redo_stack)
+
+        def _push_undo_entry(self, entry: tuple[str, object]):
+            self._push_entry(self.undo_stack, entry)
 
         def _push_undo_snapshot(self, snapshot: bytes):
-            self.undo_stack.append(snapshot)
-            if len(self.undo_stack) > self.max_history:
-                self.undo_stack.pop(0)
+            self._push_undo_entry(("doc", self._store_snapshot(snapshot)))
 
         def record_change(self, kind: str | None = None):
             if self.doc is None:
                 return
+            self._touch()
+            # Style edits reformat runs in place (splits invalidate on their own), so the cached
+            # run list stays valid and update_style can reuse it instead of re-walking the tree.
+            if kind != "style":
+                self._invalidate_runs()
             now = time.monotonic()
-            if kind == "insert" and self._last_edit_kind == "insert" and (now - self._last_edit_time) < 2.5:
+            # Text and style commands only restore what they recorded, so a change that needs a
+            # snapshot can only fold into a snapshot.
+            if self._coalesces(kind, now) and self.undo_stack[-1][0] in ("doc", "clone"):
                 self._last_edit_time = now
                 return
-            self._push_undo_snapshot(self._serialize_doc())
-            self.redo_stack.clear()
+            self._push_undo_entry(self._snapshot_entry())
+            self._clear_redo()
+            self._last_edit_time = now
+            self._last_edit_kind = kind
+
+        def _coalesces(self, kind: str | None, now: float) -> bool:
+            # Consecutive edits of the same kind within its window form one undo step.
+            window = self.coalesce_windows.get(kind)
+            return window is not None and self._last_edit_kind == kind and (now - self._last_edit_time) < window and bool(self.undo_stack)
+
+        def record_text_command(self, kind: str, delta: list[tuple[str, str]]):
+            if not delta:
+                return
+            self._touch()
+            now = time.monotonic()
+            if self._coalesces(kind, now):
+                # A snapshot on top already restores the state before the burst; an open text
+                # command only needs the oldest text of runs it hasn't seen yet.
+                top_kind, top_delta = self.undo_stack[-1]
+                if top_kind == "text":
+                    seen = {name for name, _ in top_delta}
+                    top_delta.extend(item for item in delta if item[0] not in seen)
+                self._last_edit_time = now
+                return
+            self._push_undo_entry(("text", delta))
+            self._clear_redo()
             self._last_edit_time = now
             self._last_edit_kind = kind
 
+        def record_style_command(self, delta: list[tuple[str, tuple]]):
+            if not delta:
+                return
+            self._touch()
+            now = time.monotonic()
+            if self._coalesces("style", now):
+                # Same as text commands: keep the oldest font state of each run in the burst.
+                top_kind, top_delta = self.undo_stack[-1]
+                if top_kind == "style":
+                    seen = {name for name, _ in top_delta}
+                    top_delta.extend(item for item in delta if item[0] not in seen)
+                self._last_edit_time = now
+                return
+            self._push_undo_entry(("style", delta))
+            self._clear_redo()
+            self._last_edit_time = now
+            self._last_edit_kind = "style"
+
+        def _font_state(self, font) -> tuple:
+            # font.name reads back a single script's name (the far-east one on a mixed run) and
+            # writes all four, so each script name is kept on its own.
+            return (font.name_ascii, font.name_far_east, font.name_other, font.name_bi, font.size, font.color, font.bold, font.italic)
+
+        def _set_font_state(self, font, state: tuple):
+            (font.name_ascii, font.name_far_east, font.name_other, font.name_bi, font.size, font.color, font.bold, font.italic) = state
+
+        def _apply_style_delta(self, delta: list[tuple[str, tuple]]) -> list[tuple[str, tuple]]:
+            # Replays recorded font states newest-first and returns the inverse delta.
+            inverse = []
+            for name, state in reversed(delta):
+                bm = self._find_bookmark(name)
+                run = self._run_in_bookmark(bm) if bm else None
+                if run is None:
+                    continue
+                inverse.append((name, self._font_state(run.font)))
+                self._set_font_state(run.font, state)
+            return inverse
+
+        def _apply_text_delta(self, delta: list[tuple[str, str]]) -> list[tuple[str, str]]:
+            inverse = []
+            for name, text in reversed(delta):
+                bm = self._find_bookmark(name)
+                run = self._run_in_bookmark(bm) if bm else None
+                if run is None:
+                    continue
+                inverse.append((name, run.text or ""))
+                run.text = text
+            return inverse
+
+        def _apply_history_entry(self, entry: tuple[str, object]) -> tuple[str, object]:
+            kind, payload = entry
+            if kind == "style":
+                self._touch()
+                return ("style", self._apply_style_delta(payload))
+            if kind == "text":
+                self._touch()
+                return ("text", self._apply_text_delta(payload))
+            current = self._current_entry()
+            self._touch()
+            if kind == "clone":
+                # Clones share one page-layout model, and laying out one detaches the others
+                # (extract_pages fails), so the live document is always a fresh copy.
+                self._set_doc(payload.clone())
+                return current
+            data = self._snapshot_data(payload)
+            self._release_entry(entry)
+            self._restore_doc(data)
+            return current
+
         def can_undo(self) -> bool:
             return len(self.undo_stack) > 0
 
@@ -182,61 +515,94 @@ if not USE_MOCK:
         def undo(self) -> bool:
             if not self.can_undo():
                 return False
-            current = self._serialize_doc()
-            snapshot = self.undo_stack.pop()
-            self.redo_stack.append(current)
-            if len(self.redo_stack) > self.max_history:
-                self.redo_stack.pop(0)
-            self._restore_doc(snapshot)
+            entry = self.undo_stack.pop()
+            self._push_entry(self.redo_stack, self._apply_history_entry(entry))
+            self._last_edit_kind = None
             return True
 
         def redo(self) -> bool:
             if not self.can_redo():
                 return False
-            current = self._serialize_doc()
-            snapshot = self.redo_stack.pop()
-            self._push_undo_snapshot(current)
-            self._restore_doc(snapshot)
+            entry = self.redo_stack.pop()
+            self._push_undo_entry(self._apply_history_entry(entry))
+            self._last_edit_kind = None
             return True
             
         def _clear_auto_bookmarks(self):
-            # Remove existing auto-generated bookmarks to avoid duplication/mess
-            # Iterating backwards when removing is safer
-            for i in range(self.doc.range.bookmarks.count - 1, -1, -1):
-                bm = self.doc.range.bookmarks[i]
-                if bm.name.startswith("Run_"):
-                    bm.remove()
-
-        def _inject_bookmarks(self):
-            self._clear_auto_bookmarks()
-            
-            # Traverse all Run nodes and wrap them in unique bookmarks
-            runs = self.doc.get_child_nodes(aw.NodeType.RUN, True)
-            
-            run_list = [node.as_run() for node in runs]
-            
-            for run in run_list:
-                run_id = f"Run_{uuid.uuid4().hex}"
-                run.parent_node.insert_before(aw.BookmarkStart(self.doc, run_id), run)
-                run.parent_node.insert_after(aw.BookmarkEnd(self.doc, run_id), run)
+            # Remove existing auto-generated bookmarks to avoid duplication/mess.
+            # Bookmark.remove() looks up the matching end node on every call, which goes quadratic
+            # on large documents; dropping the BookmarkStart/BookmarkEnd nodes directly is linear.
+            for node in list(self.doc.get_child_nodes(aw.NodeType.BOOKMARK_START, True)):
+                name = node.as_bookmark_start().name
+                if name.startswith("Run_"):
+                    self._bm_index.pop(name, None)
+                    node.remove()
+            for node in list(self.doc.get_child_nodes(aw.NodeType.BOOKMARK_END, True)):
+                if node.as_bookmark_end().name.startswith("Run_"):
+                    node.remove()
+
+        def _inject_bookmarks(self, clear: bool = True):
+            # Documents built by load_default have no Run_ bookmarks yet and skip the clear pass.
+            if clear:
+                self._clear_auto_bookmarks()
+
+            # Traverse all Run nodes and wrap them in unique bookmarks. Bookmarks don't change the
+            # run list, so the one built here stays valid for later edits.
+            self._invalidate_runs()
+            for run in self._all_runs():
+                run_id = self._new_run_id()
+                parent = run.parent_node
+                parent.insert_before(aw.BookmarkStart(self.doc, run_id), run)
+                parent.insert_after(aw.BookmarkEnd(self.doc, run_id), run)
+            self._reindex_bookmarks()
+
+        def _new_run_id(self) -> str:
+            # A per-state counter never repeats, even across loads and history restores, and keeps
+            # ids well under Word's 40-character bookmark name limit (longer names are cut on save).
+            self._bm_seq += 1
+            return f"Run_{self._bm_seq:x}"
+
+        def _reindex_bookmarks(self):
+            self._bm_index = {b.name: b for b in self.doc.range.bookmarks}
+
+        def _invalidate_runs(self):
+            self._runs_snapshot = None
+            self._run_index = None
+
+        def _run_positions(self):
+            if self._runs_snapshot is None:
+                self._runs_snapshot = [node.as_run() for node in self.doc.get_child_nodes(aw.NodeType.RUN, True)]
+                self._run_index = {run: i for i, run in enumerate(self._runs_snapshot)}
+            return self._runs_snapshot, self._run_index
+
+        def _all_runs(self) -> list:
+            return self._run_positions()[0]
 
         def load_default(self):
             self._reset_identity()
+            self._touch()
             self.doc = aw.Document()
             builder = aw.DocumentBuilder(self.doc)
             builder.writeln("这是一个原型文档。")
             builder.writeln("您可以使用右侧的控件更改文本的字体样式。")
             builder.writeln("Aspose.Words 使文档处理变得简单！")
-            self._inject_bookmarks()
-            self.undo_stack.clear()
-            self.redo_stack.clear()
+            self._inject_bookmarks(clear=False)
+            self._clear_stack(self.undo_stack)
+            self._clear_redo()
             self._last_edit_time = 0.0
             self._last_edit_kind = None
             
         def load_from_stream(self, file_stream):
+            # Parsed before any state changes, so a rejected upload leaves the current document as is.
+            try:
+                doc = aw.Document(file_stream)
+            except Exception as e:
+                print(f"Error loading document: {e}")
+                raise HTTPException(status_code=400, detail="Invalid document format")
             try:
                 self._reset_identity()
-                self.doc = aw.Document(file_stream)
+                self._touch()
+                self.doc = doc
                 self._inject_bookmarks()
                 self._last_edit_time = 0.0
                 self._last_edit_kind = None
@@ -245,51 +611,65 @@ if not USE_MOCK:
                 raise HTTPException(status_code=400, detail="Invalid document format")
 
         def page_count(self) -> int:
-            try:
+            with self._aspose_lock:
+                if self._page_count_revision == self._revision:
+                    return self._page_count
                 try:
-                    self.doc.update_page_layout()
+                    self._ensure_layout()
+                    c = max(1, int(getattr(self.doc, "page_count", 1) or 1))
                 except Exception:
-                    pass
-                c = int(getattr(self.doc, "page_count", 1) or 1)
-                return max(1, c)
+                    return 1
+                self._page_count = c
+                self._page_count_revision = self._revision
+                return c
+
+        def _ensure_layout(self):
+            # update_page_layout is a full pagination pass; run it at most once per revision.
+            if self._layout_revision == self._revision:
+                return
+            try:
+                self.doc.update_page_layout()
             except Exception:
-                return 1
+                pass
+            self._layout_revision = self._revision
 
         def get_html(self, page: int | None = None):
+            with self._aspose_lock:
+                key = (self._revision, page)
+                html = self._html_cache.get(key)
+                if html is not None:
+                    self._html_cache.move_to_end(key)
+                    return html
+                html = self._render_html(page)
+                self._html_cache[key] = html
+                while len(self._html_cache) > self._max_html_cache:
+                    self._html_cache.popitem(last=False)
+                return html
+
+        def _save_html(self, doc, options) -> str:
+            # Renders are serialized by _aspose_lock, so they share one buffer. It is only rewound
+            # (truncate would give its memory back) and decoded in place, without a getvalue() copy.
+            buf = self._html_buffer
+            buf.seek(0)
+            doc.save(buf, options)
+            size = buf.tell()
+            with buf.getbuffer() as view, view[:size] as written:
+                return str(written, "utf-8")
+
+        def _render_html(self, page: int | None = None):
+            options = self._html_options
             if page is None:
-                options = aw.saving.HtmlSaveOptions()
-                options.export_images_as_base64 = True
-                options.css_style_sheet_type = aw.saving.CssStyleSheetType.INLINE
-                options.pretty_format = True
-
-                out_stream = io.BytesIO()
-                self.doc.save(out_stream, options)
-                return out_stream.getvalue().decode("utf-8")
+                return self._save_html(self.doc, options)
 
             total = self.page_count()
             page = max(1, min(int(page), total))
-            options = aw.saving.HtmlSaveOptions()
-            options.export_images_as_base64 = True
-            options.css_style_sheet_type = aw.saving.CssStyleSheetType.INLINE
-            options.pretty_format = True
-
-            out_stream = io.BytesIO()
             try:
-                try:
-                    self.doc.update_page_layout()
-                except Exception:
-                    pass
+                self._ensure_layout()
                 page_doc = self.doc.extract_pages(page - 1, 1)
-                page_doc.save(out_stream, options)
-                return out_stream.getvalue().decode("utf-8")
+                return self._save_html(page_doc, options)
             except Exception:
                 try:
-                    out_stream = io.BytesIO()
-                    fixed = aw.saving.HtmlFixedSaveOptions()
-                    try:
-                        fixed.export_embedded_images = True
-                    except Exception:
-                        pass
+                    fixed = self._html_fixed_options
                     try:
                         fixed.page_index = page - 1
                         fixed.page_count = 1
@@ -298,68 +678,68 @@ if not USE_MOCK:
                             fixed.page_set = aw.saving.PageSet(page - 1)
                         except Exception:
                             pass
-                    self.doc.save(out_stream, fixed)
-                    return out_stream.getvalue().decode("utf-8")
+                    return self._save_html(self.doc, fixed)
                 except Exception as e:
                     raise HTTPException(status_code=500, detail=f"Failed to render page {page}: {e}")
 
         def _extract_body_inner_html(self, html: str) -> str:
-            m = re.search(r"<body[^>]*>([\s\S]*?)</body>", html, flags=re.IGNORECASE)
-            if m:
-                return m.group(1)
-            return html
+            start = _BODY_OPEN_RE.search(html)
+            if start is None:
+                return html
+            end = _BODY_CLOSE_RE.search(html, start.end())
+            if end is None:
+                return html
+            return html[start.end():end.start()]
 
         def _export_paragraph_html_fragment(self, para):
             # Try to export directly using to_string with options if supported (newer Aspose versions)
+            options = self._html_options
             try:
-                options = aw.saving.HtmlSaveOptions()
-                options.export_images_as_base64 = True
-                options.css_style_sheet_type = aw.saving.CssStyleSheetType.INLINE
-                options.pretty_format = True
                 html = para.to_string(options)
                 return self._extract_body_inner_html(html)
             except Exception:
                 pass
 
-            try:
-                frag_doc = aw.Document()
+            with self._aspose_lock:
                 try:
-                    section = frag_doc.sections[0]
-                    body = section.body
-                except Exception:
-                    section = getattr(frag_doc, "first_section", None)
-                    body = getattr(section, "body", None) if section is not None else None
-
-                if body is None:
-                    return None
+                    fragment = self._fragment_body()
+                    if fragment is None:
+                        return None
+                    frag_doc, body = fragment
 
-                while body.first_child is not None:
-                    body.first_child.remove()
+                    while body.first_child is not None:
+                        body.first_child.remove()
 
-                imported = None
-                try:
-                    imported = frag_doc.import_node(para, True, aw.ImportFormatMode.KEEP_SOURCE_FORMATTING)
-                except Exception:
+                    imported = None
                     try:
-                        imported = frag_doc.import_node(para, True)
+                        imported = frag_doc.import_node(para, True, aw.ImportFormatMode.KEEP_SOURCE_FORMATTING)
                     except Exception:
-                        imported = None
-
-                if imported is None:
-                    return None
+                        try:
+                            imported = frag_doc.import_node(para, True)
+                        except Exception:
+                            imported = None
 
-                body.append_child(imported)
+                    if imported is None:
+                        return None
 
-                options = aw.saving.HtmlSaveOptions()
-                options.export_images_as_base64 = True
-                options.css_style_sheet_type = aw.saving.CssStyleSheetType.INLINE
-                options.pretty_format = True
+                    body.append_child(imported)
+                    return self._extract_body_inner_html(self._save_html(frag_doc, options))
+                except Exception:
+                    return None
 
-                out_stream = io.BytesIO()
-                frag_doc.save(out_stream, options)
-                return self._extract_body_inner_html(out_stream.getvalue().decode("utf-8"))
+        def _fragment_body(self):
+            # A fresh document per export: importing with KEEP_SOURCE_FORMATTING copies the source
+            # styles into it, so a reused one would keep growing with every patch.
+            frag_doc = aw.Document()
+            try:
+                body = frag_doc.sections[0].body
             except Exception:
+                section = getattr(frag_doc, "first_section", None)
+                body = getattr(section, "body", None) if section is not None else None
+
+            if body is None:
                 return None
+            return frag_doc, body
 
         def _paragraph_from_run_bookmark(self, run_bookmark_name: str):
             bm = self._find_bookmark(run_bookmark_name)
@@ -380,6 +760,19 @@ if not USE_MOCK:
             print(f"DEBUG: Generated patch HTML for {run_bookmark_name}: {html[:200]}...")
             return {"kind": "paragraph", "anchorName": run_bookmark_name, "html": html}
 
+        def make_break_patch(self, run_bookmark_name: str):
+            # After insert_break the run id sits in the second of the two halves. The client still
+            # has the unsplit paragraph under that anchor, so it is replaced by both halves.
+            para = self._paragraph_from_run_bookmark(run_bookmark_name)
+            prev_para = self._prev_paragraph(para) if para is not None else None
+            if prev_para is None:
+                return None
+            first = self._export_paragraph_html_fragment(prev_para)
+            second = self._export_paragraph_html_fragment(para)
+            if not first or not second:
+                return None
+            return {"kind": "paragraph", "anchorName": run_bookmark_name, "html": first + second}
+
         def make_single_paragraph_patch_if_same_paragraph(self, start_run_id: str, end_run_id: str):
             start_para = self._paragraph_from_run_bookmark(start_run_id)
             end_para = self._paragraph_from_run_bookmark(end_run_id)
@@ -390,49 +783,100 @@ if not USE_MOCK:
             return self.make_paragraph_patch_by_run_id(start_run_id)
         
         def get_document_stream(self):
-            out_stream = io.BytesIO()
-            self.doc.save(out_stream, aw.SaveFormat.DOCX)
+            # Right after an undo/redo the document is still exactly the DOCX it was loaded from.
+            if self._current_bytes is not None:
+                return io.BytesIO(self._current_bytes)
+            # Aspose can't write into a SpooledTemporaryFile, so spill straight to a temp file
+            # and let the download route stream it back in chunks.
+            out_stream = tempfile.TemporaryFile()
+            with self._aspose_lock:
+                self.doc.save(out_stream, aw.SaveFormat.DOCX)
             out_stream.seek(0)
             return out_stream
 
+        def _font_fields(self, style: StyleUpdate) -> tuple:
+            # The font part of `style` read out once, with the color already parsed, for loops
+            # that write it to many runs.
+            return (
+                style.font_name or None,
+                style.font_size or None,
+                style.bold,
+                style.italic,
+                _parse_color(style.color) if style.color else None,
+            )
+
+        def _apply_font_fields(self, font, fields: tuple):
+            name, size, bold, italic, color = fields
+            if name:
+                font.name = name
+            if size:
+                font.size = size
+            if bold is not None:
+                font.bold = bold
+            if italic is not None:
+                font.italic = italic
+            if color is not None:
+                font.color = color
+
         def _apply_style_to_font(self, font, style: StyleUpdate):
-            if style.font_name:
-                font.name = style.font_name
-            if style.font_size:
-                font.size = style.font_size
-            if style.bold is not None:
-                font.bold = style.bold
-            if style.italic is not None:
-                font.italic = style.italic
+            self._apply_font_fields(font, self._font_fields(style))
+
+        def _edit_run_text(self, run, name: str | None, text: str, kind: str):
+            # Empty runs don't survive a DOCX round trip, so a text command could lose track of
+            # them after a snapshot restore; edits that empty a run (or an unnamed run) snapshot.
+            old = run.text or ""
+            if name is None or not old or not text:
+                self.record_change(kind)
+                run.text = text
+                return
+            run.text = text
+            self.record_text_command(kind, [(name, old)])
+
+        def _font_style_is_empty(self, style: StyleUpdate) -> bool:
+            # True when `style` only carries paragraph properties.
+            return not style.font_name and not style.font_size and not style.color and style.bold is None and style.italic is None
+
+        def _font_matches(self, font, style: StyleUpdate) -> bool:
+            # True when applying `style` to `font` would change nothing.
+            # font.name only reads back one script's name but setting it writes all four, so the
+            # name matches only when every script already uses it.
+            if style.font_name and not (
+                font.name_ascii == font.name_far_east == font.name_other == font.name_bi == style.font_name
+            ):
+                return False
+            if style.font_size and font.size != style.font_size:
+                return False
+            if style.bold is not None and font.bold != style.bold:
+                return False
+            if style.italic is not None and font.italic != style.italic:
+                return False
             if style.color:
-                try:
-                    if style.color.startswith("#"):
-                        hex_color = style.color.lstrip('#')
-                        r = int(hex_color[0:2], 16)
-                        g = int(hex_color[2:4], 16)
-                        b = int(hex_color[4:6], 16)
-                        c = drawing.Color.from_argb(r, g, b)
-                        font.color = c
-                except Exception as e:
-                    print(f"Error setting color: {e}")
+                c = _parse_color(style.color)
+                if c is not None and font.color.to_argb() != c.to_argb():
+                    return False
+            return True
+
+        def _paragraph_matches(self, para, style: StyleUpdate) -> bool:
+            # True when applying `style` to `para` would change nothing.
+            fmt = para.paragraph_format
+            if style.alignment:
+                alignment = _ALIGNMENTS.get(style.alignment.lower())
+                if alignment is not None and fmt.alignment != alignment:
+                    return False
+            if style.first_line_indent is not None and fmt.first_line_indent != style.first_line_indent:
+                return False
+            return True
 
         def _apply_style_to_paragraph(self, para, style: StyleUpdate):
             if style.alignment:
-                val = style.alignment.lower()
-                if val == 'left':
-                    para.paragraph_format.alignment = aw.ParagraphAlignment.LEFT
-                elif val == 'center':
-                    para.paragraph_format.alignment = aw.ParagraphAlignment.CENTER
-                elif val == 'right':
-                    para.paragraph_format.alignment = aw.ParagraphAlignment.RIGHT
-                elif val == 'justify':
-                    para.paragraph_format.alignment = aw.ParagraphAlignment.JUSTIFY
+                alignment = _ALIGNMENTS.get(style.alignment.lower())
+                if alignment is not None:
+                    para.paragraph_format.alignment = alignment
             
             if style.first_line_indent is not None:
                 para.paragraph_format.first_line_indent = style.first_line_indent
 
         def insert_text(self, node_id: str, offset: int, text: str, style: StyleUpdate | None = None):
-            self.record_change("insert")
             bm = self._find_bookmark(node_id)
             if not bm:
                 return
@@ -441,48 +885,50 @@ if not USE_MOCK:
                 return
             
             text_len = len(run.text)
-            if offset < 0: offset = 0
-            if offset > text_len: offset = text_len
+            offset = _clamp(offset, text_len)
 
             if not text:
                 return
 
+            if text_len and (style is None or self._font_matches(run.font, style)):
+                # Same formatting as the run: no split needed, the text goes straight in.
+                text_original = run.text
+                run.text = text_original[:offset] + text + text_original[offset:]
+                self.record_text_command("insert", [(node_id, text_original)])
+                return
+
+            self.record_change("insert")
             if offset == 0 and text_len == 0:
                 run.text = text
                 if style is not None:
                     self._apply_style_to_font(run.font, style)
                 return
 
-            try:
-                bm.remove()
-            except Exception:
-                pass
+            self._remove_bookmark(bm)
 
             text_original = run.text
             text_pre = text_original[:offset]
             text_post = text_original[offset:]
             parent = run.parent_node
 
+            # The original run takes the inserted text in place, so only the sides are cloned
+            # (and none at all when typing at either end of the run).
             if text_pre:
                 pre_run = run.clone(True).as_run()
                 pre_run.text = text_pre
                 parent.insert_before(pre_run, run)
-                self._wrap_run_with_bookmark(pre_run, f"{node_id}_pre_{uuid.uuid4().hex}")
-
-            inserted_run = run.clone(True).as_run()
-            inserted_run.text = text
-            if style is not None:
-                self._apply_style_to_font(inserted_run.font, style)
-            parent.insert_before(inserted_run, run)
-            self._wrap_run_with_bookmark(inserted_run, node_id)
+                self._wrap_run_with_bookmark(pre_run, self._new_run_id())
 
             if text_post:
                 post_run = run.clone(True).as_run()
                 post_run.text = text_post
-                parent.insert_before(post_run, run)
-                self._wrap_run_with_bookmark(post_run, f"{node_id}_post_{uuid.uuid4().hex}")
+                parent.insert_after(post_run, run)
+                self._wrap_run_with_bookmark(post_run, self._new_run_id())
 
-            run.remove()
+            run.text = text
+            if style is not None:
+                self._apply_style_to_font(run.font, style)
+            self._wrap_run_with_bookmark(run, node_id)
 
         def delete_range(self, start_node_id: str, start_offset: int, end_node_id: str, end_offset: int):
             self.record_change("delete")
@@ -498,8 +944,8 @@ if not USE_MOCK:
 
             if start_node_id == end_node_id and start_run == end_run:
                 text_len = len(start_run.text)
-                if start_offset < 0: start_offset = 0
-                if end_offset > text_len: end_offset = text_len
+                start_offset = _clamp(start_offset, text_len)
+                end_offset = _clamp(end_offset, text_len)
                 if start_offset >= end_offset: return
                 
                 start_run.text = start_run.text[:start_offset] + start_run.text[end_offset:]
@@ -507,24 +953,41 @@ if not USE_MOCK:
 
             start_run_len = len(start_run.text)
             end_run_len = len(end_run.text)
-            if start_offset < 0: start_offset = 0
-            if start_offset > start_run_len: start_offset = start_run_len
-            if end_offset < 0: end_offset = 0
-            if end_offset > end_run_len: end_offset = end_run_len
+            start_offset = _clamp(start_offset, start_run_len)
+            end_offset = _clamp(end_offset, end_run_len)
 
             start_run.text = start_run.text[:start_offset]
             end_run.text = end_run.text[end_offset:]
-            
-            node = start_run.next_pre_order(self.doc)
+            self._remove_runs_between(start_run, end_run)
+
+        def _remove_runs_between(self, start_run, end_run):
+            # Within one paragraph only the sibling chain is walked; across paragraphs the walk goes
+            # in document order. Run_ bookmarks that open and close inside the span go too, as they
+            # would otherwise be left wrapping nothing.
+            same_parent = start_run.parent_node == end_run.parent_node
+            step = (lambda n: n.next_sibling) if same_parent else (lambda n: n.next_pre_order(self.doc))
             nodes_to_remove = []
-            while node and node != end_run:
-                next_node = node.next_pre_order(self.doc) 
-                if node.node_type == aw.NodeType.RUN:
+            opened = {}
+            node = step(start_run)
+            while node is not None and node != end_run:
+                node_type = node.node_type
+                if node_type == aw.NodeType.RUN:
                     nodes_to_remove.append(node)
-                node = next_node
-            
+                elif node_type == aw.NodeType.BOOKMARK_START:
+                    name = node.as_bookmark_start().name
+                    if name.startswith("Run_"):
+                        opened[name] = node
+                elif node_type == aw.NodeType.BOOKMARK_END:
+                    name = node.as_bookmark_end().name
+                    start = opened.pop(name, None)
+                    if start is not None:
+                        nodes_to_remove += (start, node)
+                        self._bm_index.pop(name, None)
+                node = step(node)
+
             for n in nodes_to_remove:
                 n.remove()
+            self._invalidate_runs()
 
         def _ancestor_paragraph(self, node):
             cur = node
@@ -594,20 +1057,7 @@ if not USE_MOCK:
                 return None
             return self._first_run_in_paragraph(next_para)
 
-        def _bookmark_name_for_run(self, run) -> str | None:
-            try:
-                for b in self.doc.range.bookmarks:
-                    if not getattr(b, "name", "").startswith("Run_"):
-                        continue
-                    r = self._run_in_bookmark(b)
-                    if r is not None and r == run:
-                        return b.name
-            except Exception:
-                return None
-            return None
-
         def delete_backward(self, node_id: str, offset: int):
-            self.record_change("delete")
             bm = self._find_bookmark(node_id)
             if not bm:
                 return {"node_id": node_id, "offset": max(0, offset)}
@@ -616,9 +1066,9 @@ if not USE_MOCK:
                 return {"node_id": node_id, "offset": max(0, offset)}
 
             text = run.text or ""
-            offset = max(0, min(int(offset), len(text)))
+            offset = _clamp(int(offset), len(text))
             if offset > 0:
-                run.text = text[: offset - 1] + text[offset:]
+                self._edit_run_text(run, node_id, text[: offset - 1] + text[offset:], "delete")
                 return {"node_id": node_id, "offset": offset - 1}
 
             prev_run = self._prev_run(run)
@@ -627,9 +1077,11 @@ if not USE_MOCK:
 
             cur_para = self._ancestor_paragraph(run)
             prev_para = self._ancestor_paragraph(prev_run)
-            prev_id = self._bookmark_name_for_run(prev_run) or node_id
+            prev_name = self._run_bookmark_name(prev_run)
+            prev_id = prev_name or node_id
 
             if cur_para is not None and prev_para is not None and cur_para != prev_para:
+                self.record_change("delete")
                 node_to_move = cur_para.first_child
                 while node_to_move is not None:
                     nxt = node_to_move.next_sibling
@@ -640,12 +1092,29 @@ if not USE_MOCK:
 
             prev_text = prev_run.text or ""
             if prev_text:
-                prev_run.text = prev_text[:-1]
+                self._edit_run_text(prev_run, prev_name, prev_text[:-1], "delete")
                 return {"node_id": prev_id, "offset": len(prev_run.text or "")}
             return {"node_id": prev_id, "offset": 0}
 
+        def delete_backward_n(self, node_id: str, offset: int, count: int):
+            # A held-down backspace arrives as one request with a count. Characters inside the
+            # caret's run go in a single edit; only what is left crosses runs one step at a time.
+            sel = {"node_id": node_id, "offset": max(0, offset)}
+            bm = self._find_bookmark(node_id)
+            run = self._run_in_bookmark(bm) if bm else None
+            if run is not None:
+                text = run.text or ""
+                offset = _clamp(int(offset), len(text))
+                n = min(count, offset)
+                if n > 0:
+                    self._edit_run_text(run, node_id, text[: offset - n] + text[offset:], "delete")
+                    sel = {"node_id": node_id, "offset": offset - n}
+                    count -= n
+            for _ in range(count):
+                sel = self.delete_backward(sel["node_id"], sel["offset"])
+            return sel
+
         def delete_forward(self, node_id: str, offset: int):
-            self.record_change("delete")
             bm = self._find_bookmark(node_id)
             if not bm:
                 return {"node_id": node_id, "offset": max(0, offset)}
@@ -654,9 +1123,9 @@ if not USE_MOCK:
                 return {"node_id": node_id, "offset": max(0, offset)}
 
             text = run.text or ""
-            offset = max(0, min(int(offset), len(text)))
+            offset = _clamp(int(offset), len(text))
             if offset < len(text):
-                run.text = text[:offset] + text[offset + 1 :]
+                self._edit_run_text(run, node_id, text[:offset] + text[offset + 1 :], "delete")
                 return {"node_id": node_id, "offset": offset}
 
             next_run = self._next_run(run)
@@ -666,6 +1135,7 @@ if not USE_MOCK:
             cur_para = self._ancestor_paragraph(run)
             next_para = self._ancestor_paragraph(next_run)
             if cur_para is not None and next_para is not None and cur_para != next_para:
+                self.record_change("delete")
                 node_to_move = next_para.first_child
                 while node_to_move is not None:
                     nxt = node_to_move.next_sibling
@@ -676,9 +1146,26 @@ if not USE_MOCK:
 
             next_text = next_run.text or ""
             if next_text:
-                next_run.text = next_text[1:]
+                self._edit_run_text(next_run, self._run_bookmark_name(next_run), next_text[1:], "delete")
             return {"node_id": node_id, "offset": len(run.text or "")}
 
+        def delete_forward_n(self, node_id: str, offset: int, count: int):
+            # Forward counterpart of delete_backward_n.
+            sel = {"node_id": node_id, "offset": max(0, offset)}
+            bm = self._find_bookmark(node_id)
+            run = self._run_in_bookmark(bm) if bm else None
+            if run is not None:
+                text = run.text or ""
+                offset = _clamp(int(offset), len(text))
+                n = min(count, len(text) - offset)
+                if n > 0:
+                    self._edit_run_text(run, node_id, text[:offset] + text[offset + n :], "delete")
+                    sel = {"node_id": node_id, "offset": offset}
+                    count -= n
+            for _ in range(count):
+                sel = self.delete_forward(sel["node_id"], sel["offset"])
+            return sel
+
         def insert_break(self, node_id: str, offset: int):
             self.record_change("break")
             bm = self._find_bookmark(node_id)
@@ -693,14 +1180,11 @@ if not USE_MOCK:
                 return {"node_id": node_id, "offset": 0}
 
             text_original = run.text or ""
-            offset = max(0, min(int(offset), len(text_original)))
+            offset = _clamp(int(offset), len(text_original))
             text_pre = text_original[:offset]
             text_post = text_original[offset:]
 
-            try:
-                bm.remove()
-            except Exception:
-                pass
+            self._remove_bookmark(bm)
 
             parent = run.parent_node
 
@@ -708,48 +1192,66 @@ if not USE_MOCK:
                 pre_run = run.clone(True).as_run()
                 pre_run.text = text_pre
                 parent.insert_before(pre_run, run)
-                self._wrap_run_with_bookmark(pre_run, f"{node_id}_pre_{uuid.uuid4().hex}")
+                self._wrap_run_with_bookmark(pre_run, self._new_run_id())
 
             new_para = aw.Paragraph(self.doc)
             para.parent_node.insert_after(new_para, para)
 
-            post_run = run.clone(True).as_run()
-            post_run.text = text_post
-            new_para.append_child(post_run)
-            self._wrap_run_with_bookmark(post_run, node_id)
-
-            run.remove()
+            # The run itself moves into the new paragraph with the text after the caret, so only
+            # the side before it is cloned.
+            run.text = text_post
+            new_para.append_child(run)
+            self._wrap_run_with_bookmark(run, node_id)
             return {"node_id": node_id, "offset": 0}
 
 
         def update_style(self, font_name: str = None, font_size: float = None, color: str = None, alignment: str = None, first_line_indent: float = None, bold: bool = None, italic: bool = None):
-            self.record_change("style")
             style = StyleUpdate(font_name=font_name, font_size=font_size, color=color, alignment=alignment, first_line_indent=first_line_indent, bold=bold, italic=italic)
-            
-            # Update Runs (Font properties)
-            if font_name or font_size or color or bold is not None or italic is not None:
-                runs = self.doc.get_child_nodes(aw.NodeType.RUN, True)
-                for run in runs:
-                    run = run.as_run()
-                    self._apply_style_to_font(run.font, style)
+            font_change = font_name or font_size or color or bold is not None or italic is not None
+            para_change = alignment or first_line_indent is not None
+            paras = [node.as_paragraph() for node in self.doc.get_child_nodes(aw.NodeType.PARAGRAPH, True)] if para_change else []
+            # Re-applying what is already there (a slider released on its current value) is not
+            # an edit: no snapshot, no new revision.
+            if (not font_change or all(self._font_matches(run.font, style) for run in self._all_runs())) and all(
+                self._paragraph_matches(para, style) for para in paras
+            ):
+                return
+            self.record_change("style")
+
+            # Update Runs (Font properties). Direct run formatting would override a Normal-style
+            # change, so every run is still written, but the color is parsed once for all of them.
+            if font_change:
+                fields = self._font_fields(style)
+                for run in self._all_runs():
+                    self._apply_font_fields(run.font, fields)
 
             # Update Paragraphs (Paragraph properties)
-            if alignment or first_line_indent is not None:
-                paras = self.doc.get_child_nodes(aw.NodeType.PARAGRAPH, True)
-                for para in paras:
-                    self._apply_style_to_paragraph(para.as_paragraph(), style)
+            for para in paras:
+                self._apply_style_to_paragraph(para, style)
 
         def update_node_style(self, node_id: str, start_offset: int, end_offset: int, style: StyleUpdate):
             return self.update_range_style(node_id, start_offset, node_id, end_offset, style)
 
         def _find_bookmark(self, bookmark_name: str):
+            bm = self._bm_index.get(bookmark_name)
+            if bm is not None:
+                return bm
+            # The index is kept in step with every bookmark edit, so this scan only runs for ids
+            # that are gone. BookmarkCollection has no name indexer here (it raises TypeError).
+            for b in self.doc.range.bookmarks:
+                if b.name == bookmark_name:
+                    bm = b
+                    break
+            if bm is not None:
+                self._bm_index[bookmark_name] = bm
+            return bm
+
+        def _remove_bookmark(self, bm):
+            self._bm_index.pop(bm.name, None)
             try:
-                return self.doc.range.bookmarks[bookmark_name]
-            except TypeError:
-                for b in self.doc.range.bookmarks:
-                    if b.name == bookmark_name:
-                        return b
-            return None
+                bm.remove()
+            except Exception:
+                pass
 
         def _run_in_bookmark(self, bookmark):
             current_node = bookmark.bookmark_start.next_sibling
@@ -761,10 +1263,37 @@ if not USE_MOCK:
 
         def _wrap_run_with_bookmark(self, run, bookmark_name: str):
             parent = run.parent_node
-            parent.insert_before(aw.BookmarkStart(self.doc, bookmark_name), run)
+            start = aw.BookmarkStart(self.doc, bookmark_name)
+            parent.insert_before(start, run)
             parent.insert_after(aw.BookmarkEnd(self.doc, bookmark_name), run)
+            self._bm_index[bookmark_name] = start.bookmark
+
+        def _run_bookmark_name(self, run) -> str | None:
+            # Name of the Run_ bookmark whose first run is `run`: walk back over the non-run
+            # siblings to the nearest open BookmarkStart, skipping bookmarks that close before
+            # the run. Constant time per lookup instead of a scan over every bookmark.
+            closed = set()
+            node = run.previous_sibling
+            while node is not None and node.node_type != aw.NodeType.RUN:
+                if node.node_type == aw.NodeType.BOOKMARK_END:
+                    closed.add(node.as_bookmark_end().name)
+                elif node.node_type == aw.NodeType.BOOKMARK_START:
+                    name = node.as_bookmark_start().name
+                    if name.startswith("Run_") and name not in closed:
+                        return name
+                node = node.previous_sibling
+            return None
 
-        def _split_run_keep_mid_id(self, run, bookmark_name: str, start_offset: int, end_offset: int, apply_style: StyleUpdate | None):
+        def _apply_style_to_run(self, run, fields: tuple, delta: list | None = None):
+            if delta is not None:
+                name = self._run_bookmark_name(run)
+                if name is None:
+                    name = self._new_run_id()
+                    self._wrap_run_with_bookmark(run, name)
+                delta.append((name, self._font_state(run.font)))
+            self._apply_font_fields(run.font, fields)
+
+        def _split_run_keep_mid_id(self, run, bookmark_name: str, start_offset: int, end_offset: int, apply_fields: tuple | None, delta: list | None = None):
             text_original = run.text
             text_pre = text_original[:start_offset]
             text_mid = text_original[start_offset:end_offset]
@@ -773,31 +1302,55 @@ if not USE_MOCK:
             parent = run.parent_node
 
             pre_run = None
-            mid_run = None
             post_run = None
 
             if text_pre:
                 pre_run = run.clone(True).as_run()
                 pre_run.text = text_pre
                 parent.insert_before(pre_run, run)
-                self._wrap_run_with_bookmark(pre_run, f"{bookmark_name}_pre_{uuid.uuid4().hex}")
-
-            if text_mid:
-                mid_run = run.clone(True).as_run()
-                mid_run.text = text_mid
-                if apply_style is not None:
-                    self._apply_style_to_font(mid_run.font, apply_style)
-                parent.insert_before(mid_run, run)
-                self._wrap_run_with_bookmark(mid_run, bookmark_name)
+                self._wrap_run_with_bookmark(pre_run, self._new_run_id())
 
             if text_post:
                 post_run = run.clone(True).as_run()
                 post_run.text = text_post
-                parent.insert_before(post_run, run)
-                self._wrap_run_with_bookmark(post_run, f"{bookmark_name}_post_{uuid.uuid4().hex}")
-
-            run.remove()
-            return pre_run, mid_run, post_run
+                parent.insert_after(post_run, run)
+                self._wrap_run_with_bookmark(post_run, self._new_run_id())
+
+            if not text_mid:
+                run.remove()
+                self._invalidate_runs()
+                return pre_run, None, post_run
+
+            # The original run becomes the middle part in place, so only the sides are cloned.
+            if pre_run is not None or post_run is not None:
+                run.text = text_mid
+                self._invalidate_runs()
+            self._wrap_run_with_bookmark(run, bookmark_name)
+            if apply_fields is not None:
+                self._apply_style_to_run(run, apply_fields, delta)
+            return pre_run, run, post_run
+
+        def _following_paragraph(self, para):
+            # Next paragraph in document order, stepping over `para`'s own runs instead of
+            # visiting them one by one.
+            node = para
+            while node is not None and node.next_sibling is None:
+                node = node.parent_node
+            node = node.next_sibling if node is not None else None
+            while node is not None and node.node_type != aw.NodeType.PARAGRAPH:
+                node = node.next_pre_order(self.doc)
+            return node.as_paragraph() if node is not None else None
+
+        def _paragraphs_between(self, start_run, end_run) -> list:
+            para = self._ancestor_paragraph(start_run)
+            end_para = self._ancestor_paragraph(end_run)
+            paragraphs = []
+            while para is not None:
+                paragraphs.append(para)
+                if para == end_para:
+                    break
+                para = self._following_paragraph(para)
+            return paragraphs
 
         def update_range_style(self, start_node_id: str, start_offset: int, end_node_id: str, end_offset: int, style: StyleUpdate):
             print(f"DEBUG: update_range_style called with style: {style}")
@@ -811,103 +1364,100 @@ if not USE_MOCK:
             if not start_run or not end_run:
                 return None
 
-            self.record_change("style")
+            # Alignment or indent alone never touches the runs, so there is nothing to split or walk.
+            if self._font_style_is_empty(style):
+                paragraphs = self._paragraphs_between(start_run, end_run)
+                if not all(self._paragraph_matches(p, style) for p in paragraphs):
+                    self.record_change("style")
+                    for p in paragraphs:
+                        self._apply_style_to_paragraph(p, style)
+                return {
+                    "startNodeId": start_node_id,
+                    "startOffset": _clamp(start_offset, len(start_run.text)),
+                    "endNodeId": end_node_id,
+                    "endOffset": _clamp(end_offset, len(end_run.text)),
+                }
+
+            # Font-only edits that restyle whole runs are undone through a per-run style command.
+            # Splitting a run or changing paragraph formatting alters structure the command
+            # can't restore, so those still take a full document snapshot.
+            if start_node_id == end_node_id and start_run == end_run:
+                text_len = len(start_run.text)
+                lo, hi = _clamp(start_offset, text_len), _clamp(end_offset, text_len)
+                needs_split = lo < hi and not (lo == 0 and hi == text_len)
+            else:
+                start_len, end_len = len(start_run.text), len(end_run.text)
+                needs_split = 0 < start_offset < start_len or 0 < end_offset < end_len
+            fields = self._font_fields(style)
+            delta = None
+            if style.alignment or style.first_line_indent is not None or needs_split:
+                self.record_change("style")
+            else:
+                delta = []
 
             # Apply alignment to paragraphs in range
             if style.alignment or style.first_line_indent is not None:
-                paragraphs_to_update = set()
-                
-                def add_para_from_node(n):
-                    if n.node_type == aw.NodeType.PARAGRAPH:
-                        paragraphs_to_update.add(n.as_paragraph())
-                    else:
-                        p = self._ancestor_paragraph(n)
-                        if p: paragraphs_to_update.add(p)
-
-                if start_run == end_run:
-                    add_para_from_node(start_run)
-                else:
-                    curr = start_run
-                    while curr and curr != end_run:
-                        add_para_from_node(curr)
-                        curr = curr.next_pre_order(self.doc)
-                    add_para_from_node(end_run)
-                
-                for p in paragraphs_to_update:
+                for p in self._paragraphs_between(start_run, end_run):
                     self._apply_style_to_paragraph(p, style)
 
             if start_node_id == end_node_id and start_run == end_run:
                 text_len = len(start_run.text)
-                if start_offset < 0:
-                    start_offset = 0
-                if end_offset > text_len:
-                    end_offset = text_len
+                start_offset = _clamp(start_offset, text_len)
+                end_offset = _clamp(end_offset, text_len)
                 if start_offset >= end_offset:
                     return {"startNodeId": start_node_id, "startOffset": start_offset, "endNodeId": end_node_id, "endOffset": end_offset}
                 if start_offset == 0 and end_offset == text_len:
-                    self._apply_style_to_font(start_run.font, style)
+                    self._apply_style_to_run(start_run, fields, delta)
+                    self.record_style_command(delta)
                     return {"startNodeId": start_node_id, "startOffset": 0, "endNodeId": end_node_id, "endOffset": text_len}
-                try:
-                    start_bm.remove()
-                except Exception:
-                    pass
-                self._split_run_keep_mid_id(start_run, start_node_id, start_offset, end_offset, style)
+                self._remove_bookmark(start_bm)
+                self._split_run_keep_mid_id(start_run, start_node_id, start_offset, end_offset, fields, delta)
+                self.record_style_command(delta)
                 return {"startNodeId": start_node_id, "startOffset": 0, "endNodeId": end_node_id, "endOffset": max(0, end_offset - start_offset)}
 
             start_run_len = len(start_run.text)
             end_run_len = len(end_run.text)
-            if start_offset < 0:
-                start_offset = 0
-            if start_offset > start_run_len:
-                start_offset = start_run_len
-            if end_offset < 0:
-                end_offset = 0
-            if end_offset > end_run_len:
-                end_offset = end_run_len
+            start_offset = _clamp(start_offset, start_run_len)
+            end_offset = _clamp(end_offset, end_run_len)
 
             start_cursor_run = start_run
             end_cursor_run = end_run
-            include_end_run = True
             selection_start_offset = start_offset
             selection_end_offset = end_offset
 
-            if start_offset == start_run_len:
-                start_cursor_run = start_run
-            elif start_offset == 0:
-                self._apply_style_to_font(start_run.font, style)
-                start_cursor_run = start_run
-            else:
-                try:
-                    start_bm.remove()
-                except Exception:
-                    pass
-                _, mid, _ = self._split_run_keep_mid_id(start_run, start_node_id, start_offset, start_run_len, style)
+            # Each end run is styled here at most once; the walk below only covers the runs
+            # strictly between the two cursors.
+            if start_offset == 0 < start_run_len:
+                self._apply_style_to_run(start_run, fields, delta)
+            elif start_offset < start_run_len:
+                self._remove_bookmark(start_bm)
+                _, mid, _ = self._split_run_keep_mid_id(start_run, start_node_id, start_offset, start_run_len, fields, delta)
                 start_cursor_run = mid if mid is not None else start_run
                 selection_start_offset = 0
 
-            if end_offset == 0:
-                include_end_run = False
-                end_cursor_run = end_run
-            elif end_offset == end_run_len:
-                self._apply_style_to_font(end_run.font, style)
-                end_cursor_run = end_run
-            else:
-                try:
-                    end_bm.remove()
-                except Exception:
-                    pass
-                _, mid, _ = self._split_run_keep_mid_id(end_run, end_node_id, 0, end_offset, style)
+            if 0 < end_offset == end_run_len:
+                self._apply_style_to_run(end_run, fields, delta)
+            elif end_offset > 0:
+                self._remove_bookmark(end_bm)
+                # The split already styles the kept part.
+                _, mid, _ = self._split_run_keep_mid_id(end_run, end_node_id, 0, end_offset, fields, delta)
                 end_cursor_run = mid if mid is not None else end_run
-                selection_end_offset = len(end_cursor_run.text or "") if end_cursor_run is not None else end_offset
-
-            node = start_cursor_run.next_pre_order(self.doc)
-            while node and node != end_cursor_run:
-                if node.node_type == aw.NodeType.RUN:
-                    self._apply_style_to_font(node.as_run().font, style)
-                node = node.next_pre_order(self.doc)
+                selection_end_offset = len(end_cursor_run.text or "")
+
+            runs, run_index = self._run_positions()
+            first = run_index.get(start_cursor_run)
+            last = run_index.get(end_cursor_run)
+            if first is not None and last is not None:
+                for run in runs[first + 1:last]:
+                    self._apply_style_to_run(run, fields, delta)
+            else:
+                node = start_cursor_run.next_pre_order(self.doc)
+                while node and node != end_cursor_run:
+                    if node.node_type == aw.NodeType.RUN:
+                        self._apply_style_to_run(node.as_run(), fields, delta)
+                    node = node.next_pre_order(self.doc)
 
-            if include_end_run and end_cursor_run and end_cursor_run.node_type == aw.NodeType.RUN:
-                self._apply_style_to_font(end_cursor_run.as_run().font, style)
+            self.record_style_command(delta)
 
             return {
                 "startNodeId": start_node_id,
@@ -918,16 +1468,25 @@ if not USE_MOCK:
 
 else:
     # --- Mock Implementation ---
+    _MOCK_HTML_OPEN = "<html><body>"
+    _MOCK_HTML_CLOSE = "</body></html>"
+
     class DocumentState:
         def __init__(self):
             self.doc_id = uuid.uuid4().hex
             self.version = 0
-            self.undo_stack: list[dict] = []
-            self.redo_stack: list[dict] = []
             self.max_history = 50
-            self._applied_ops: dict[str, dict] = {}
-            self._applied_ops_order: list[str] = []
+            self.undo_stack: deque[dict] = deque(maxlen=self.max_history)
+            self.redo_stack: deque[dict] = deque(maxlen=self.max_history)
+            self._applied_ops: OrderedDict[str, bytes] = OrderedDict()
             self._max_applied_ops = 5000
+            # Full-page responses are far larger than patches, so the cache is also bounded by size.
+            self._applied_ops_bytes = 0
+            self._max_applied_bytes = 64 * 1024 * 1024
+            # Rendered pages with the ids they assign; dropped whenever the content can change.
+            self._html_cache: dict[tuple, tuple[str, list[str]]] = {}
+            self._prefix_style: tuple | None = None
+            self._prefix = ""
             self.load_default()
 
         def _reset_identity(self):
@@ -940,19 +1499,27 @@ else:
 
         def get_cached_response(self, req_doc_id: str, req_base_version: int, client_op_id: str, page: int | None):
             key = self._op_cache_key(req_doc_id, req_base_version, client_op_id, page)
-            return self._applied_ops.get(key)
+            body = self._applied_ops.get(key)
+            if body is not None:
+                self._applied_ops.move_to_end(key)
+            return body
 
-        def cache_response(self, req_doc_id: str, req_base_version: int, client_op_id: str, page: int | None, payload: dict):
+        def cache_response(self, req_doc_id: str, req_base_version: int, client_op_id: str, page: int | None, payload: dict) -> bytes:
             key = self._op_cache_key(req_doc_id, req_base_version, client_op_id, page)
-            if key in self._applied_ops:
-                return
-            self._applied_ops[key] = payload
-            self._applied_ops_order.append(key)
-            overflow = len(self._applied_ops_order) - self._max_applied_ops
-            if overflow > 0:
-                for _ in range(overflow):
-                    oldest = self._applied_ops_order.pop(0)
-                    self._applied_ops.pop(oldest, None)
+            body = self._applied_ops.get(key)
+            if body is not None:
+                self._applied_ops.move_to_end(key)
+                return body
+            # Stored encoded, so a replayed request is answered without serializing again.
+            body = _json_bytes(payload)
+            self._applied_ops[key] = body
+            self._applied_ops_bytes += len(body)
+            while len(self._applied_ops) > 1 and (
+                len(self._applied_ops) > self._max_applied_ops or self._applied_ops_bytes > self._max_applied_bytes
+            ):
+                _, evicted = self._applied_ops.popitem(last=False)
+                self._applied_ops_bytes -= len(evicted)
+            return body
 
         def validate_version(self, req_doc_id: str, req_base_version: int):
             if req_doc_id != self.doc_id:
@@ -963,30 +1530,36 @@ else:
 
         def bump_version(self):
             self.version += 1
+            self._html_cache.clear()
 
-        def _snapshot(self):
-            return {
+        def _snapshot(self, mutates_text: bool = True):
+            prev = {
                 "font_name": self.font_name,
                 "font_size": self.font_size,
                 "color": self.color,
-                "text": list(self.text),
             }
+            # The text is an immutable tuple, so entries share it instead of copying it,
+            # and style-only edits leave it out altogether.
+            if mutates_text:
+                prev["text"] = self.text
+            return {"kind": "text" if mutates_text else "style", "prev": prev}
 
         def _restore(self, snapshot: dict):
-            self.font_name = snapshot.get("font_name", "Arial")
-            self.font_size = snapshot.get("font_size", 12)
-            self.color = snapshot.get("color", "#000000")
-            self.text = list(snapshot.get("text", []))
+            for field, value in snapshot["prev"].items():
+                setattr(self, field, value)
+            self._html_cache.clear()
 
         def _push_undo_snapshot(self, snapshot: dict):
             self.undo_stack.append(snapshot)
-            if len(self.undo_stack) > self.max_history:
-                self.undo_stack.pop(0)
 
-        def record_change(self):
-            self._push_undo_snapshot(self._snapshot())
+        def _clear_redo(self):
             self.redo_stack.clear()
 
+        def record_change(self, mutates_text: bool = False):
+            self._push_undo_snapshot(self._snapshot(mutates_text))
+            self.redo_stack.clear()
+            self._html_cache.clear()
+
         def can_undo(self) -> bool:
             return len(self.undo_stack) > 0
 
@@ -1004,19 +1577,17 @@ else:
         def undo(self) -> bool:
             if not self.can_undo():
                 return False
-            current = self._snapshot()
             snapshot = self.undo_stack.pop()
+            current = self._snapshot(snapshot["kind"] == "text")
             self.redo_stack.append(current)
-            if len(self.redo_stack) > self.max_history:
-                self.redo_stack.pop(0)
             self._restore(snapshot)
             return True
 
         def redo(self) -> bool:
             if not self.can_redo():
                 return False
-            current = self._snapshot()
             snapshot = self.redo_stack.pop()
+            current = self._snapshot(snapshot["kind"] == "text")
             self._push_undo_snapshot(current)
             self._restore(snapshot)
             return True
@@ -1026,36 +1597,50 @@ else:
             self.font_name = "Arial"
             self.font_size = 12
             self.color = "#000000"
-            self.text = [
+            self.text = (
                 "这是一个原型文档（模拟模式）。",
                 "您可以使用右侧的控件更改文本的字体样式。",
-                "Aspose.Words 未安装在当前环境中，但逻辑已准备就绪。"
-            ]
-            self.ids = [] 
+                "Aspose.Words 未安装在当前环境中，但逻辑已准备就绪。",
+            )
+            self.ids = []
+            self._html_cache.clear()
             self.undo_stack.clear()
             self.redo_stack.clear()
 
         def load_from_stream(self, file_stream):
             self._reset_identity()
-            self.text = [
+            self.text = (
                 "您已上传新文档（模拟模式）。",
                 "由于 Aspose.Words 未安装在当前环境中，我无法渲染真实内容。",
-                "但我可以模拟文件已成功接收！"
-            ]
+                "但我可以模拟文件已成功接收！",
+            )
+            self._html_cache.clear()
 
         def page_count(self) -> int:
             return 1
 
+        def _paragraph_prefix(self) -> str:
+            # The style is shared by every line and changes far less often than the text, so the
+            # paragraph prefix is only formatted again when the style does.
+            style = (self.font_name, self.font_size, self.color)
+            if self._prefix_style != style:
+                self._prefix = f"<p style=\"font-family: '{self.font_name}'; font-size: {self.font_size}pt; color: {self.color};\">"
+                self._prefix_style = style
+            return self._prefix
+
         def get_html(self, page: int | None = None):
-            style = f"font-family: '{self.font_name}'; font-size: {self.font_size}pt; color: {self.color};"
-            html_parts = ["<html><body>"]
-            self.ids = []
-            for i, line in enumerate(self.text):
-                run_id = f"Run_Mock_{i}"
-                self.ids.append(run_id)
-                html_parts.append(f"<p style=\"{style}\"><a name=\"{run_id}\">{line}</a></p>")
-            html_parts.append("</body></html>")
-            return "\n".join(html_parts)
+            key = (self.version, page, self.font_name, self.font_size, self.color)
+            cached = self._html_cache.get(key)
+            if cached is not None:
+                html, ids = cached
+                self.ids = list(ids)
+                return html
+            prefix = self._paragraph_prefix()
+            self.ids = [f"Run_Mock_{i}" for i in range(len(self.text))]
+            body = "\n".join([f'{prefix}<a name="{rid}">{line}</a></p>' for rid, line in zip(self.ids, self.text)])
+            html = f"{_MOCK_HTML_OPEN}\n{body}\n{_MOCK_HTML_CLOSE}" if body else f"{_MOCK_HTML_OPEN}\n{_MOCK_HTML_CLOSE}"
+            self._html_cache[key] = (html, list(self.ids))
+            return html
         
         def get_document_stream(self):
             content = "\n".join(self.text)
@@ -1077,311 +1662,301 @@ else:
             print(f"MOCK: Updating range '{start_node_id}' [{start_offset}:{end_offset}] -> '{end_node_id}' to style {style}")
             pass
 
-doc_state = DocumentState()
+class _RWLock:
+    """Writer-preferring asyncio reader/writer lock."""
+
+    def __init__(self):
+        self._cond = asyncio.Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @contextlib.asynccontextmanager
+    async def reader(self):
+        async with self._cond:
+            # Queued writers go first so a steady stream of renders can't starve edits.
+            await self._cond.wait_for(lambda: not self._writer and not self._waiting_writers)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def writer(self):
+        async with self._cond:
+            self._waiting_writers += 1
+            try:
+                await self._cond.wait_for(lambda: not self._writer and not self._readers)
+            finally:
+                self._waiting_writers -= 1
+                # Wake readers held back by this writer if it was cancelled while waiting.
+                self._cond.notify_all()
+            self._writer = True
+        try:
+            yield
+        finally:
+            async with self._cond:
+                self._writer = False
+                self._cond.notify_all()
 
 
-def _conflict_response(conflict: dict, page: int):
-    total = doc_state.page_count() if hasattr(doc_state, "page_count") else 1
-    page = max(1, min(int(page), total))
+doc_state = DocumentState()
+# Mutating requests hold the writer side for their whole read-modify-render sequence;
+# render and download only read the document and share the reader side.
+# Blocking Aspose calls run in worker threads either way.
+_doc_lock = _RWLock()
+
+# The backend is fixed for the life of the process, so the routes resolve the optional
+# operations once here instead of probing doc_state on every request.
+_page_count = doc_state.page_count
+_delete_backward_n = getattr(doc_state, "delete_backward_n", None)
+_delete_forward_n = getattr(doc_state, "delete_forward_n", None)
+_insert_break = getattr(doc_state, "insert_break", None)
+_make_para_patch = None if USE_MOCK else doc_state.make_paragraph_patch_by_run_id
+_make_single_para_patch = None if USE_MOCK else doc_state.make_single_paragraph_patch_if_same_paragraph
+_make_break_patch = None if USE_MOCK else doc_state.make_break_patch
+
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+
+def _spool_upload(src, chunk_size: int = UPLOAD_CHUNK_SIZE):
+    # Aspose needs a real seekable file object (it rejects SpooledTemporaryFile), so the upload
+    # is copied chunk by chunk into an anonymous temp file instead of being read into memory.
+    tmp = tempfile.TemporaryFile()
+    try:
+        src.seek(0)
+        shutil.copyfileobj(src, tmp, chunk_size)
+        tmp.seek(0)
+    except Exception:
+        tmp.close()
+        raise
+    return tmp
+
+
+def _json_bytes(payload) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(payload)
+    # Same encoding FastAPI's JSONResponse uses.
+    return json.dumps(payload, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+def _json_response(body: bytes, status_code: int = 200) -> Response:
+    return Response(content=body, status_code=status_code, media_type="application/json")
+
+
+def _iter_file(f, chunk_size: int = DOWNLOAD_CHUNK_SIZE):
+    try:
+        while chunk := f.read(chunk_size):
+            yield chunk
+    finally:
+        f.close()
+
+
+async def _page_window(page: int) -> tuple[int, int]:
+    # Clamp the requested page and return it with the page count.
+    if USE_MOCK:
+        # The mock document is always a single page.
+        return 1, 1
+    total = await asyncio.to_thread(_page_count)
+    return max(1, min(int(page), total)), total
+
+
+async def _conflict_response(conflict: dict, page: int):
+    page, total = await _page_window(page)
     payload = {
         **conflict,
         "history": doc_state.history(),
         "pageIndex": page,
         "pageCount": total,
-        "html": doc_state.get_html(page),
-    }
-    return JSONResponse(status_code=409, content=payload)
-
-@app.get("/api/init")
-async def init_document(page: int = 1):
-    doc_state.load_default()
-    total = doc_state.page_count() if hasattr(doc_state, "page_count") else 1
-    page = max(1, min(int(page), total))
-    return {
-        "docId": doc_state.doc_id,
-        "version": doc_state.version,
-        "html": doc_state.get_html(page),
-        "history": doc_state.history(),
-        "pageIndex": page,
-        "pageCount": total,
+        "html": await asyncio.to_thread(doc_state.get_html, page),
     }
+    return _json_response(_json_bytes(payload), status_code=409)
 
 
-@app.post("/api/insert_text")
-async def insert_text_endpoint(data: TextInsert, page: int = 1):
-    cached = doc_state.get_cached_response(data.doc_id, data.base_version, data.client_op_id, page)
+async def _begin_op(doc_id: str, base_version: int, client_op_id: str, page: int) -> Response | None:
+    # Shared preamble of the editing routes: a replayed op is answered from the cache and an op
+    # against a stale version gets a 409. None means the op may go ahead.
+    cached = doc_state.get_cached_response(doc_id, base_version, client_op_id, page)
     if cached is not None:
-        return cached
-    conflict = doc_state.validate_version(data.doc_id, data.base_version)
+        return _json_response(cached)
+    conflict = doc_state.validate_version(doc_id, base_version)
     if conflict is not None:
-        return _conflict_response(conflict, page)
-    doc_state.insert_text(data.node_id, data.offset, data.text, data.style)
-    doc_state.bump_version()
-    total = doc_state.page_count() if hasattr(doc_state, "page_count") else 1
-    page = max(1, min(int(page), total))
-    patch = None
-    if not USE_MOCK and hasattr(doc_state, "make_paragraph_patch_by_run_id"):
-        patch = doc_state.make_paragraph_patch_by_run_id(data.node_id)
+        return await _conflict_response(conflict, page)
+    return None
+
+
+async def _finish_op(doc_id: str, base_version: int, client_op_id: str, page: int, patch: dict | None = None, **extra) -> Response:
+    # Build, cache and return the response for an applied op: a paragraph patch when there is
+    # one, the rendered page otherwise, plus any route-specific fields that are not None.
+    page, total = await _page_window(page)
     payload = {"docId": doc_state.doc_id, "version": doc_state.version, "history": doc_state.history(), "pageIndex": page, "pageCount": total}
     if patch:
         payload["patches"] = [patch]
-        doc_state.cache_response(data.doc_id, data.base_version, data.client_op_id, page, payload)
-        return payload
-    payload["html"] = doc_state.get_html(page)
-    doc_state.cache_response(data.doc_id, data.base_version, data.client_op_id, page, payload)
-    return payload
+    else:
+        payload["html"] = await asyncio.to_thread(doc_state.get_html, page)
+    payload.update((k, v) for k, v in extra.items() if v is not None)
+    return _json_response(doc_state.cache_response(doc_id, base_version, client_op_id, page, payload))
+
+
+async def _paragraph_patch(node_id: str):
+    if _make_para_patch is None:
+        return None
+    return await asyncio.to_thread(_make_para_patch, node_id)
+
+
+async def _range_patch(start_node_id: str, end_node_id: str):
+    if _make_single_para_patch is None:
+        return None
+    return await asyncio.to_thread(_make_single_para_patch, start_node_id, end_node_id)
+
+
+def _caret_selection(sel: dict) -> dict:
+    return {"startNodeId": sel["node_id"], "startOffset": sel["offset"], "endNodeId": sel["node_id"], "endOffset": sel["offset"]}
+
+@app.get("/api/init")
+async def init_document(page: int = 1):
+    async with _doc_lock.writer():
+        await asyncio.to_thread(doc_state.load_default)
+        page, total = await _page_window(page)
+        return _json_response(_json_bytes({
+            "docId": doc_state.doc_id,
+            "version": doc_state.version,
+            "html": await asyncio.to_thread(doc_state.get_html, page),
+            "history": doc_state.history(),
+            "pageIndex": page,
+            "pageCount": total,
+        }))
+
+
+@app.post("/api/insert_text")
+async def insert_text_endpoint(data: TextInsert, page: int = 1):
+    async with _doc_lock.writer():
+        if (early := await _begin_op(data.doc_id, data.base_version, data.client_op_id, page)) is not None:
+            return early
+        await asyncio.to_thread(doc_state.insert_text, data.node_id, data.offset, data.text, data.style)
+        doc_state.bump_version()
+        patch = await _paragraph_patch(data.node_id)
+        return await _finish_op(data.doc_id, data.base_version, data.client_op_id, page, patch)
 
 
 @app.post("/api/delete_range")
 async def delete_range_endpoint(data: RangeDelete, page: int = 1):
-    cached = doc_state.get_cached_response(data.doc_id, data.base_version, data.client_op_id, page)
-    if cached is not None:
-        return cached
-    conflict = doc_state.validate_version(data.doc_id, data.base_version)
-    if conflict is not None:
-        return _conflict_response(conflict, page)
-    doc_state.delete_range(data.start_node_id, data.start_offset, data.end_node_id, data.end_offset)
-    doc_state.bump_version()
-    total = doc_state.page_count() if hasattr(doc_state, "page_count") else 1
-    page = max(1, min(int(page), total))
-    patch = None
-    if not USE_MOCK and hasattr(doc_state, "make_single_paragraph_patch_if_same_paragraph"):
-        patch = doc_state.make_single_paragraph_patch_if_same_paragraph(data.start_node_id, data.end_node_id)
-    payload = {"docId": doc_state.doc_id, "version": doc_state.version, "history": doc_state.history(), "pageIndex": page, "pageCount": total}
-    if patch:
-        payload["patches"] = [patch]
-        doc_state.cache_response(data.doc_id, data.base_version, data.client_op_id, page, payload)
-        return payload
-    payload["html"] = doc_state.get_html(page)
-    doc_state.cache_response(data.doc_id, data.base_version, data.client_op_id, page, payload)
-    return payload
+    async with _doc_lock.writer():
+        if (early := await _begin_op(data.doc_id, data.base_version, data.client_op_id, page)) is not None:
+            return early
+        await asyncio.to_thread(doc_state.delete_range, data.start_node_id, data.start_offset, data.end_node_id, data.end_offset)
+        doc_state.bump_version()
+        patch = await _range_patch(data.start_node_id, data.end_node_id)
+        return await _finish_op(data.doc_id, data.base_version, data.client_op_id, page, patch)
 
 @app.post("/api/delete_backward")
 async def delete_backward_endpoint(data: CaretPosition, page: int = 1):
-    cached = doc_state.get_cached_response(data.doc_id, data.base_version, data.client_op_id, page)
-    if cached is not None:
-        return cached
-    conflict = doc_state.validate_version(data.doc_id, data.base_version)
-    if conflict is not None:
-        return _conflict_response(conflict, page)
-    sel = {"node_id": data.node_id, "offset": max(0, int(data.offset))}
-    if hasattr(doc_state, "delete_backward"):
-        count = max(1, int(getattr(data, "count", 1) or 1))
-        for _ in range(count):
-            sel = doc_state.delete_backward(sel["node_id"], sel["offset"])
-    doc_state.bump_version()
-    total = doc_state.page_count() if hasattr(doc_state, "page_count") else 1
-    page = max(1, min(int(page), total))
-    patch = None
-    if not USE_MOCK and hasattr(doc_state, "make_paragraph_patch_by_run_id"):
-        patch = doc_state.make_paragraph_patch_by_run_id(sel["node_id"])
-    payload = {
-        "docId": doc_state.doc_id,
-        "version": doc_state.version,
-        "history": doc_state.history(),
-        "pageIndex": page,
-        "pageCount": total,
-        **({"patches": [patch]} if patch else {"html": doc_state.get_html(page)}),
-        "selection": {
-            "startNodeId": sel["node_id"],
-            "startOffset": sel["offset"],
-            "endNodeId": sel["node_id"],
-            "endOffset": sel["offset"],
-        },
-    }
-    doc_state.cache_response(data.doc_id, data.base_version, data.client_op_id, page, payload)
-    return payload
+    async with _doc_lock.writer():
+        if (early := await _begin_op(data.doc_id, data.base_version, data.client_op_id, page)) is not None:
+            return early
+        sel = {"node_id": data.node_id, "offset": max(0, int(data.offset))}
+        if _delete_backward_n is not None:
+            count = max(1, int(getattr(data, "count", 1) or 1))
+            sel = await asyncio.to_thread(_delete_backward_n, data.node_id, sel["offset"], count)
+        doc_state.bump_version()
+        patch = await _paragraph_patch(sel["node_id"])
+        return await _finish_op(data.doc_id, data.base_version, data.client_op_id, page, patch, selection=_caret_selection(sel))
 
 @app.post("/api/delete_forward")
 async def delete_forward_endpoint(data: CaretPosition, page: int = 1):
-    cached = doc_state.get_cached_response(data.doc_id, data.base_version, data.client_op_id, page)
-    if cached is not None:
-        return cached
-    conflict = doc_state.validate_version(data.doc_id, data.base_version)
-    if conflict is not None:
-        return _conflict_response(conflict, page)
-    sel = {"node_id": data.node_id, "offset": max(0, int(data.offset))}
-    if hasattr(doc_state, "delete_forward"):
-        count = max(1, int(getattr(data, "count", 1) or 1))
-        for _ in range(count):
-            sel = doc_state.delete_forward(sel["node_id"], sel["offset"])
-    doc_state.bump_version()
-    total = doc_state.page_count() if hasattr(doc_state, "page_count") else 1
-    page = max(1, min(int(page), total))
-    patch = None
-    if not USE_MOCK and hasattr(doc_state, "make_paragraph_patch_by_run_id"):
-        patch = doc_state.make_paragraph_patch_by_run_id(sel["node_id"])
-    payload = {
-        "docId": doc_state.doc_id,
-        "version": doc_state.version,
-        "history": doc_state.history(),
-        "pageIndex": page,
-        "pageCount": total,
-        **({"patches": [patch]} if patch else {"html": doc_state.get_html(page)}),
-        "selection": {
-            "startNodeId": sel["node_id"],
-            "startOffset": sel["offset"],
-            "endNodeId": sel["node_id"],
-            "endOffset": sel["offset"],
-        },
-    }
-    doc_state.cache_response(data.doc_id, data.base_version, data.client_op_id, page, payload)
-    return payload
+    async with _doc_lock.writer():
+        if (early := await _begin_op(data.doc_id, data.base_version, data.client_op_id, page)) is not None:
+            return early
+        sel = {"node_id": data.node_id, "offset": max(0, int(data.offset))}
+        if _delete_forward_n is not None:
+            count = max(1, int(getattr(data, "count", 1) or 1))
+            sel = await asyncio.to_thread(_delete_forward_n, data.node_id, sel["offset"], count)
+        doc_state.bump_version()
+        patch = await _paragraph_patch(sel["node_id"])
+        return await _finish_op(data.doc_id, data.base_version, data.client_op_id, page, patch, selection=_caret_selection(sel))
 
 @app.post("/api/insert_break")
 async def insert_break_endpoint(data: CaretPosition, page: int = 1):
-    cached = doc_state.get_cached_response(data.doc_id, data.base_version, data.client_op_id, page)
-    if cached is not None:
-        return cached
-    conflict = doc_state.validate_version(data.doc_id, data.base_version)
-    if conflict is not None:
-        return _conflict_response(conflict, page)
-    sel = {"node_id": data.node_id, "offset": 0}
-    if hasattr(doc_state, "insert_break"):
-        sel = doc_state.insert_break(data.node_id, data.offset)
-    doc_state.bump_version()
-    total = doc_state.page_count() if hasattr(doc_state, "page_count") else 1
-    page = max(1, min(int(page), total))
-    payload = {
-        "docId": doc_state.doc_id,
-        "version": doc_state.version,
-        "html": doc_state.get_html(page),
-        "history": doc_state.history(),
-        "pageIndex": page,
-        "pageCount": total,
-        "selection": {
-            "startNodeId": sel["node_id"],
-            "startOffset": sel["offset"],
-            "endNodeId": sel["node_id"],
-            "endOffset": sel["offset"],
-        },
-    }
-    doc_state.cache_response(data.doc_id, data.base_version, data.client_op_id, page, payload)
-    return payload
+    async with _doc_lock.writer():
+        if (early := await _begin_op(data.doc_id, data.base_version, data.client_op_id, page)) is not None:
+            return early
+        sel = {"node_id": data.node_id, "offset": 0}
+        if _insert_break is not None:
+            sel = await asyncio.to_thread(_insert_break, data.node_id, data.offset)
+        doc_state.bump_version()
+        patch = await asyncio.to_thread(_make_break_patch, sel["node_id"]) if _make_break_patch is not None else None
+        return await _finish_op(data.doc_id, data.base_version, data.client_op_id, page, patch, selection=_caret_selection(sel))
 
 
 @app.get("/api/render")
 async def render_document(page: int = 1):
-    total = doc_state.page_count() if hasattr(doc_state, "page_count") else 1
-    page = max(1, min(int(page), total))
-    return {
-        "docId": doc_state.doc_id,
-        "version": doc_state.version,
-        "html": doc_state.get_html(page),
-        "history": doc_state.history(),
-        "pageIndex": page,
-        "pageCount": total,
-    }
+    async with _doc_lock.reader():
+        page, total = await _page_window(page)
+        return _json_response(_json_bytes({
+            "docId": doc_state.doc_id,
+            "version": doc_state.version,
+            "html": await asyncio.to_thread(doc_state.get_html, page),
+            "history": doc_state.history(),
+            "pageIndex": page,
+            "pageCount": total,
+        }))
 
 @app.post("/api/update")
 async def update_document(data: UpdateDocumentRequest, page: int = 1):
-    cached = doc_state.get_cached_response(data.doc_id, data.base_version, data.client_op_id, page)
-    if cached is not None:
-        return cached
-    conflict = doc_state.validate_version(data.doc_id, data.base_version)
-    if conflict is not None:
-        return _conflict_response(conflict, page)
-    doc_state.update_style(data.font_name, data.font_size, data.color, data.alignment, data.first_line_indent, data.bold, data.italic)
-    doc_state.bump_version()
-    total = doc_state.page_count() if hasattr(doc_state, "page_count") else 1
-    page = max(1, min(int(page), total))
-    payload = {
-        "docId": doc_state.doc_id,
-        "version": doc_state.version,
-        "html": doc_state.get_html(page),
-        "history": doc_state.history(),
-        "pageIndex": page,
-        "pageCount": total,
-    }
-    doc_state.cache_response(data.doc_id, data.base_version, data.client_op_id, page, payload)
-    return payload
+    async with _doc_lock.writer():
+        if (early := await _begin_op(data.doc_id, data.base_version, data.client_op_id, page)) is not None:
+            return early
+        await asyncio.to_thread(doc_state.update_style, data.font_name, data.font_size, data.color, data.alignment, data.first_line_indent, data.bold, data.italic)
+        doc_state.bump_version()
+        return await _finish_op(data.doc_id, data.base_version, data.client_op_id, page)
 
 @app.post("/api/update_node")
 async def update_node(update: NodeUpdate, page: int = 1):
-    cached = doc_state.get_cached_response(update.doc_id, update.base_version, update.client_op_id, page)
-    if cached is not None:
-        return cached
-    conflict = doc_state.validate_version(update.doc_id, update.base_version)
-    if conflict is not None:
-        return _conflict_response(conflict, page)
-    sel = doc_state.update_node_style(update.node_id, update.start_offset, update.end_offset, update.style)
-    doc_state.bump_version()
-    total = doc_state.page_count() if hasattr(doc_state, "page_count") else 1
-    page = max(1, min(int(page), total))
-    patch = None
-    if not USE_MOCK and hasattr(doc_state, "make_paragraph_patch_by_run_id"):
-        patch = doc_state.make_paragraph_patch_by_run_id(update.node_id)
-    payload = {"docId": doc_state.doc_id, "version": doc_state.version, "history": doc_state.history(), "pageIndex": page, "pageCount": total}
-    if patch:
-        payload["patches"] = [patch]
-    else:
-        payload["html"] = doc_state.get_html(page)
-    if sel:
-        payload["selection"] = sel
-    doc_state.cache_response(update.doc_id, update.base_version, update.client_op_id, page, payload)
-    return payload
+    async with _doc_lock.writer():
+        if (early := await _begin_op(update.doc_id, update.base_version, update.client_op_id, page)) is not None:
+            return early
+        sel = await asyncio.to_thread(doc_state.update_node_style, update.node_id, update.start_offset, update.end_offset, update.style)
+        doc_state.bump_version()
+        patch = await _paragraph_patch(update.node_id)
+        return await _finish_op(update.doc_id, update.base_version, update.client_op_id, page, patch, selection=sel or None)
 
 
 @app.post("/api/update_range")
 async def update_range(update: RangeUpdate, page: int = 1):
-    cached = doc_state.get_cached_response(update.doc_id, update.base_version, update.client_op_id, page)
-    if cached is not None:
-        return cached
-    conflict = doc_state.validate_version(update.doc_id, update.base_version)
-    if conflict is not None:
-        return _conflict_response(conflict, page)
-    sel = doc_state.update_range_style(update.start_node_id, update.start_offset, update.end_node_id, update.end_offset, update.style)
-    doc_state.bump_version()
-    total = doc_state.page_count() if hasattr(doc_state, "page_count") else 1
-    page = max(1, min(int(page), total))
-    patch = None
-    if not USE_MOCK and hasattr(doc_state, "make_single_paragraph_patch_if_same_paragraph"):
-        patch = doc_state.make_single_paragraph_patch_if_same_paragraph(update.start_node_id, update.end_node_id)
-    payload = {"docId": doc_state.doc_id, "version": doc_state.version, "history": doc_state.history(), "pageIndex": page, "pageCount": total}
-    if patch:
-        payload["patches"] = [patch]
-    else:
-        payload["html"] = doc_state.get_html(page)
-    if sel:
-        payload["selection"] = sel
-    doc_state.cache_response(update.doc_id, update.base_version, update.client_op_id, page, payload)
-    return payload
+    async with _doc_lock.writer():
+        if (early := await _begin_op(update.doc_id, update.base_version, update.client_op_id, page)) is not None:
+            return early
+        sel = await asyncio.to_thread(doc_state.update_range_style, update.start_node_id, update.start_offset, update.end_node_id, update.end_offset, update.style)
+        doc_state.bump_version()
+        patch = await _range_patch(update.start_node_id, update.end_node_id)
+        return await _finish_op(update.doc_id, update.base_version, update.client_op_id, page, patch, selection=sel or None)
 
 
 @app.post("/api/undo")
 async def undo_document(data: HistoryOpRequest, page: int = 1):
-    cached = doc_state.get_cached_response(data.doc_id, data.base_version, data.client_op_id, page)
-    if cached is not None:
-        return cached
-    conflict = doc_state.validate_version(data.doc_id, data.base_version)
-    if conflict is not None:
-        return _conflict_response(conflict, page)
-    did_undo = doc_state.undo()
-    if did_undo:
-        doc_state.bump_version()
-    total = doc_state.page_count() if hasattr(doc_state, "page_count") else 1
-    page = max(1, min(int(page), total))
-    payload = {"docId": doc_state.doc_id, "version": doc_state.version, "html": doc_state.get_html(page), "history": doc_state.history(), "pageIndex": page, "pageCount": total, "didUndo": did_undo}
-    doc_state.cache_response(data.doc_id, data.base_version, data.client_op_id, page, payload)
-    return payload
+    async with _doc_lock.writer():
+        if (early := await _begin_op(data.doc_id, data.base_version, data.client_op_id, page)) is not None:
+            return early
+        did_undo = await asyncio.to_thread(doc_state.undo)
+        if did_undo:
+            doc_state.bump_version()
+        return await _finish_op(data.doc_id, data.base_version, data.client_op_id, page, didUndo=did_undo)
 
 
 @app.post("/api/redo")
 async def redo_document(data: HistoryOpRequest, page: int = 1):
-    cached = doc_state.get_cached_response(data.doc_id, data.base_version, data.client_op_id, page)
-    if cached is not None:
-        return cached
-    conflict = doc_state.validate_version(data.doc_id, data.base_version)
-    if conflict is not None:
-        return _conflict_response(conflict, page)
-    did_redo = doc_state.redo()
-    if did_redo:
-        doc_state.bump_version()
-    total = doc_state.page_count() if hasattr(doc_state, "page_count") else 1
-    page = max(1, min(int(page), total))
-    payload = {"docId": doc_state.doc_id, "version": doc_state.version, "html": doc_state.get_html(page), "history": doc_state.history(), "pageIndex": page, "pageCount": total, "didRedo": did_redo}
-    doc_state.cache_response(data.doc_id, data.base_version, data.client_op_id, page, payload)
-    return payload
+    async with _doc_lock.writer():
+        if (early := await _begin_op(data.doc_id, data.base_version, data.client_op_id, page)) is not None:
+            return early
+        did_redo = await asyncio.to_thread(doc_state.redo)
+        if did_redo:
+            doc_state.bump_version()
+        return await _finish_op(data.doc_id, data.base_version, data.client_op_id, page, didRedo=did_redo)
 
 @app.post("/api/upload")
 async def upload_document(
@@ -1391,42 +1966,63 @@ async def upload_document(
     client_op_id: str = Form(...),
     page: int = 1,
 ):
-    cached = doc_state.get_cached_response(doc_id, base_version, client_op_id, page)
-    if cached is not None:
-        return cached
-    conflict = doc_state.validate_version(doc_id, base_version)
-    if conflict is not None:
-        return _conflict_response(conflict, page)
-    content = await file.read()
-    file_stream = io.BytesIO(content)
-    snapshot = None
-    if not USE_MOCK:
-        snapshot = doc_state._serialize_doc() if getattr(doc_state, "doc", None) is not None else None
-    else:
-        snapshot = doc_state._snapshot()
-
-    doc_state.load_from_stream(file_stream)
-    if snapshot is not None:
-        doc_state._push_undo_snapshot(snapshot)
-        doc_state.redo_stack.clear()
-    total = doc_state.page_count() if hasattr(doc_state, "page_count") else 1
-    page = 1
-    payload = {"docId": doc_state.doc_id, "version": doc_state.version, "html": doc_state.get_html(page), "history": doc_state.history(), "pageIndex": page, "pageCount": total}
-    doc_state.cache_response(doc_id, base_version, client_op_id, page, payload)
-    return payload
+    async with _doc_lock.writer():
+        if (early := await _begin_op(doc_id, base_version, client_op_id, page)) is not None:
+            return early
+        file_stream = await asyncio.to_thread(_spool_upload, file.file)
+        try:
+            entry = None
+            if not USE_MOCK:
+                # The current document is replaced below, so it becomes the undo entry as-is.
+                entry = await asyncio.to_thread(doc_state._current_entry) if getattr(doc_state, "doc", None) is not None else None
+            else:
+                entry = doc_state._snapshot()
+
+            try:
+                await asyncio.to_thread(doc_state.load_from_stream, file_stream)
+            except BaseException:
+                # The entry never reaches the undo stack, so its snapshot reference goes back.
+                if entry is not None and not USE_MOCK:
+                    doc_state._release_entry(entry)
+                raise
+        finally:
+            file_stream.close()
+        if entry is not None:
+            if not USE_MOCK:
+                # Pushing a clone entry can demote older clones to DOCX, which is a save per clone.
+                await asyncio.to_thread(doc_state._push_undo_entry, entry)
+            else:
+                doc_state._push_undo_snapshot(entry)
+            doc_state._clear_redo()
+        # A new document always opens on its first page.
+        return await _finish_op(doc_id, base_version, client_op_id, 1)
 
 @app.get("/api/download")
 async def download_document():
-    stream = doc_state.get_document_stream()
+    async with _doc_lock.reader():
+        stream = await asyncio.to_thread(doc_state.get_document_stream)
     filename = "modified_document.docx" if not USE_MOCK else "mock_document.txt"
     media_type = "application/vnd.openxmlformats-officedocument.wordprocessingml.document" if not USE_MOCK else "text/plain"
-    
+
     return StreamingResponse(
-        stream, 
+        _iter_file(stream),
         media_type=media_type,
         headers={"Content-Disposition": f"attachment; filename={filename}"}
     )
 
 if __name__ == "__main__":
+    import importlib.util
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # uvloop + httptools are the fast pair but optional (uvloop has no Windows build), so fall back
+    # to asyncio + h11 when they're missing. Stay on one worker: the document lives in this
+    # process's doc_state, so scaling out first needs per-process documents or a shared
+    # snapshot store.
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop" if importlib.util.find_spec("uvloop") else "asyncio",
+        http="httptools" if importlib.util.find_spec("httptools") else "h11",
+        log_level="warning",
+        workers=1,
+    )
@@ -2,34 +2,52 @@ import argparse
 import json
 import re
 import uuid
-from urllib.parse import urlencode
-from urllib.request import Request, urlopen
+from http.client import HTTPConnection, HTTPSConnection
+from urllib.parse import urlencode, urlsplit
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def http_json(method: str, url: str, payload: dict | None = None) -> dict:
+_RUN_RE = re.compile(r"(Run_[0-9a-f]+)")
+_INSERTED_TEXT = "ABCDE"
+_STYLE_COLOR = "#ff0000"
+
+
+def open_connection(base_url: str) -> HTTPConnection:
+    # One keep-alive connection is reused for every request of the check.
+    parts = urlsplit(base_url)
+    conn_cls = HTTPSConnection if parts.scheme == "https" else HTTPConnection
+    return conn_cls(parts.netloc, timeout=10)
+
+
+def http_json(conn: HTTPConnection, method: str, path: str, payload: dict | None = None) -> dict:
     data = None
     headers = {}
     if payload is not None:
-        data = json.dumps(payload).encode("utf-8")
+        data = orjson.dumps(payload) if orjson is not None else json.dumps(payload).encode("utf-8")
         headers["Content-Type"] = "application/json"
-    req = Request(url, data=data, headers=headers, method=method.upper())
-    with urlopen(req, timeout=10) as resp:
-        body = resp.read().decode("utf-8")
-        return json.loads(body)
+    conn.request(method.upper(), path, body=data, headers=headers)
+    resp = conn.getresponse()
+    body = resp.read()
+    if resp.status >= 400:
+        raise SystemExit(f"{method.upper()} {path} failed with HTTP {resp.status}: {body[:200].decode('utf-8', 'replace')}")
+    # Both decoders take the raw bytes, so the body is not decoded to str first.
+    return orjson.loads(body) if orjson is not None else json.loads(body)
 
 
-def main() -> int:
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--base-url", default="http://localhost:8000")
-    parser.add_argument("--page", type=int, default=1)
-    args = parser.parse_args()
+def run_check(conn: HTTPConnection, prefix: str = "", page: int = 1) -> None:
+    # Raises SystemExit on failure. Takes the connection from the caller so a harness running
+    # the check repeatedly can keep one connection open across runs.
+    query = urlencode({"page": page})
 
-    init = http_json("GET", f"{args.base_url}/api/init?{urlencode({'page': args.page})}")
+    init = http_json(conn, "GET", f"{prefix}/api/init?{query}")
     doc_id = init["docId"]
     version = init["version"]
     html = init.get("html", "")
 
-    m = re.search(r"(Run_[0-9a-f]+)", html)
+    m = _RUN_RE.search(html)
     if not m:
         raise SystemExit("No Run_ anchor found in init HTML")
     run_id = m.group(1)
@@ -37,32 +55,32 @@ def main() -> int:
     insert = {
         "doc_id": doc_id,
         "base_version": version,
-        "client_op_id": str(uuid.uuid4()),
+        "client_op_id": uuid.uuid4().hex,
         "node_id": run_id,
         "offset": 0,
-        "text": "ABCDE",
+        "text": _INSERTED_TEXT,
     }
-    ins_res = http_json("POST", f"{args.base_url}/api/insert_text?{urlencode({'page': args.page})}", insert)
+    ins_res = http_json(conn, "POST", f"{prefix}/api/insert_text?{query}", insert)
     doc_id = ins_res["docId"]
     version = ins_res["version"]
 
     update = {
         "doc_id": doc_id,
         "base_version": version,
-        "client_op_id": str(uuid.uuid4()),
+        "client_op_id": uuid.uuid4().hex,
         "start_node_id": run_id,
         "start_offset": 0,
         "end_node_id": run_id,
-        "end_offset": 5,
-        "style": {"color": "#ff0000"},
+        "end_offset": len(_INSERTED_TEXT),
+        "style": {"color": _STYLE_COLOR},
     }
-    upd_res = http_json("POST", f"{args.base_url}/api/update_range?{urlencode({'page': args.page})}", update)
+    upd_res = http_json(conn, "POST", f"{prefix}/api/update_range?{query}", update)
     doc_id = upd_res["docId"]
     version = upd_res["version"]
 
-    ren = http_json("GET", f"{args.base_url}/api/render?{urlencode({'page': args.page})}")
+    ren = http_json(conn, "GET", f"{prefix}/api/render?{query}")
     html2 = ren.get("html", "")
-    expected = f'<a name="{run_id}"><span style="color:#ff0000">ABCDE</span></a>'
+    expected = f'<a name="{run_id}"><span style="color:{_STYLE_COLOR}">{_INSERTED_TEXT}</span></a>'
     if expected not in html2:
         raise SystemExit("Regression check failed: styled inserted text not found")
     if ren.get("docId") != doc_id:
@@ -70,6 +88,17 @@ def main() -> int:
     if ren.get("version") != version:
         raise SystemExit("Regression check failed: version mismatch after render")
 
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--page", type=int, default=1)
+    args = parser.parse_args()
+    conn = open_connection(args.base_url)
+    try:
+        run_check(conn, urlsplit(args.base_url).path.rstrip("/"), args.page)
+    finally:
+        conn.close()
     print("OK")
     return 0
 
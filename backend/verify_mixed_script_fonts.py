@@ -0,0 +1,88 @@
+import io
+
+import aspose.words as aw
+
+import main as backend
+
+# One run whose ascii and far-east fonts differ, the way Word stores mixed Chinese/Latin text.
+MIXED_TEXT = "中文 text here"
+ASCII_FONT = "Arial"
+FAR_EAST_FONT = "SimSun"
+
+
+def load_mixed_run(state) -> tuple:
+    doc = aw.Document()
+    builder = aw.DocumentBuilder(doc)
+    builder.font.name_ascii = ASCII_FONT
+    builder.font.name_other = ASCII_FONT
+    builder.font.name_far_east = FAR_EAST_FONT
+    builder.write(MIXED_TEXT)
+    stream = io.BytesIO()
+    doc.save(stream, aw.SaveFormat.DOCX)
+    stream.seek(0)
+    state.load_from_stream(stream)
+    for node in state.doc.get_child_nodes(aw.NodeType.RUN, True):
+        run = node.as_run()
+        if run.text == MIXED_TEXT:
+            return run, state._run_bookmark_name(run)
+    raise SystemExit("Mixed-script run not found after load")
+
+
+def script_names(run) -> tuple:
+    font = run.font
+    return (font.name_ascii, font.name_far_east, font.name_other)
+
+
+def check_undo_restores_script_names(state) -> None:
+    run, run_id = load_mixed_run(state)
+    before = script_names(run)
+    state.update_range_style(run_id, 0, run_id, len(MIXED_TEXT), backend.StyleUpdate(font_size=20))
+    state.undo()
+    run = state._run_in_bookmark(state._find_bookmark(run_id))
+    if script_names(run) != before:
+        raise SystemExit(f"Regression check failed: undo left script fonts {script_names(run)}, expected {before}")
+
+
+def check_insert_applies_font_name(state) -> None:
+    run, run_id = load_mixed_run(state)
+    state.insert_text(run_id, len(MIXED_TEXT), "x", backend.StyleUpdate(font_name=FAR_EAST_FONT))
+    for node in state.doc.get_child_nodes(aw.NodeType.RUN, True):
+        run = node.as_run()
+        if "x" in run.text and "text" not in run.text:
+            if script_names(run) != (FAR_EAST_FONT,) * 3:
+                raise SystemExit(f"Regression check failed: inserted text has script fonts {script_names(run)}")
+            return
+    raise SystemExit("Regression check failed: inserted text was merged into the mixed-script run")
+
+
+def check_update_style_applies_font_name(state) -> None:
+    run, run_id = load_mixed_run(state)
+    # Every other run (e.g. an evaluation banner) already uses the font, so only the mixed run
+    # stands between update_style and its no-op shortcut.
+    for other in state._all_runs():
+        if other.text != MIXED_TEXT:
+            other.font.name = FAR_EAST_FONT
+    before = script_names(run)
+    state.update_style(font_name=FAR_EAST_FONT)
+    run = state._run_in_bookmark(state._find_bookmark(run_id))
+    if script_names(run) != (FAR_EAST_FONT,) * 3:
+        raise SystemExit(f"Regression check failed: update_style left script fonts {script_names(run)}")
+    state.undo()
+    run = state._run_in_bookmark(state._find_bookmark(run_id))
+    if script_names(run) != before:
+        raise SystemExit(f"Regression check failed: undo left script fonts {script_names(run)}, expected {before}")
+
+
+def main() -> int:
+    if backend.USE_MOCK:
+        raise SystemExit("Aspose.Words is required for this check")
+    state = backend.doc_state
+    check_undo_restores_script_names(state)
+    check_insert_applies_font_name(state)
+    check_update_style_applies_font_name(state)
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
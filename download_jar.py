@@ -1,17 +1,25 @@
 import urllib.request
 import os
+import shutil
 
 base_url = "https://releases.aspose.com/java/repo/com/aspose/aspose-words/25.12/"
 filenames = ["aspose-words-25.12-jdk17.jar", "aspose-words-25.12.jar"]
 output_dir = "lib"
+chunk_size = 1 << 20
 
 for filename in filenames:
     url = base_url + filename
     output_path = os.path.join(output_dir, filename)
+    part_path = output_path + ".part"
     print(f"Trying to download {url}...")
     try:
-        urllib.request.urlretrieve(url, output_path)
+        # Stream in 1 MiB chunks into a side file, so a failed attempt leaves no truncated jar behind.
+        with urllib.request.urlopen(url, timeout=60) as resp, open(part_path, "wb") as f:
+            shutil.copyfileobj(resp, f, chunk_size)
+        os.replace(part_path, output_path)
         print(f"Successfully downloaded {filename}")
         break
     except Exception as e:
+        if os.path.exists(part_path):
+            os.remove(part_path)
         print(f"Failed to download {filename}: {e}")
@@ -1,6 +1,27 @@
 import aspose.words as aw
+import functools
 import io
 
+
+# Built on first use and reused after that, so a harness calling test_indent_export in a loop
+# doesn't configure new option objects every run. A failure to build them still surfaces
+# inside the method that needs them.
+@functools.lru_cache(maxsize=None)
+def _inline_options():
+    options = aw.saving.HtmlSaveOptions()
+    options.css_style_sheet_type = aw.saving.CssStyleSheetType.INLINE
+    options.export_images_as_base64 = True # Fix error
+    return options
+
+
+@functools.lru_cache(maxsize=None)
+def _pretty_inline_options():
+    options = aw.saving.HtmlSaveOptions()
+    options.css_style_sheet_type = aw.saving.CssStyleSheetType.INLINE
+    options.pretty_format = True
+    return options
+
+
 def test_indent_export():
     doc = aw.Document()
     builder = aw.DocumentBuilder(doc)
@@ -14,10 +35,7 @@ def test_indent_export():
     
     # Test method 1: para.to_string(options)
     try:
-        options = aw.saving.HtmlSaveOptions()
-        options.css_style_sheet_type = aw.saving.CssStyleSheetType.INLINE
-        options.export_images_as_base64 = True # Fix error
-        html = para.to_string(options)
+        html = para.to_string(_inline_options())
         print("Method 1 (para.to_string) result:")
         print(html)
     except Exception as e:
@@ -30,12 +48,8 @@ def test_indent_export():
         imported = frag_doc.import_node(para, True, aw.ImportFormatMode.KEEP_SOURCE_FORMATTING)
         frag_doc.first_section.body.append_child(imported)
         
-        options = aw.saving.HtmlSaveOptions()
-        options.css_style_sheet_type = aw.saving.CssStyleSheetType.INLINE
-        options.pretty_format = True
-        
         out_stream = io.BytesIO()
-        frag_doc.save(out_stream, options)
+        frag_doc.save(out_stream, _pretty_inline_options())
         html = out_stream.getvalue().decode("utf-8")
         print("Method 2 (frag_doc) result:")
         print(html)
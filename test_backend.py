@@ -2,8 +2,11 @@ import requests
 import uuid
 
 def test_backend_indent():
+    # One session so both requests share a keep-alive connection.
+    session = requests.Session()
+
     # 1. Init
-    res = requests.get("http://localhost:8000/api/init")
+    res = session.get("http://localhost:8000/api/init")
     data = res.json()
     doc_id = data["docId"]
     version = data["version"]
@@ -16,7 +19,7 @@ def test_backend_indent():
     # Or I can use update_range if I knew IDs.
     # Let's try update_document first as it also uses _apply_style_to_paragraph.
     
-    client_op_id = str(uuid.uuid4())
+    client_op_id = uuid.uuid4().hex
     payload = {
         "doc_id": doc_id,
         "base_version": version,
@@ -26,7 +29,7 @@ def test_backend_indent():
     }
     
     print("Sending update request:", payload)
-    res = requests.post("http://localhost:8000/api/update", json=payload)
+    res = session.post("http://localhost:8000/api/update", json=payload)
     if res.status_code != 200:
         print("Error:", res.text)
         return